@@ -9,11 +9,18 @@ import jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 from database import db
+from cache import TTLCache
+from hashing import password_pool
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
 ALGORITHM = os.environ.get('ALGORITHM')
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# authenticated users, keyed by username, so most requests skip the users lookup
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_SECONDS = float(os.environ.get('USER_CACHE_SECONDS', 60))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_SECONDS)
+
 
 class Token(BaseModel):
     access_token: str
@@ -41,20 +48,35 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 router = APIRouter()
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    # bcrypt is slow on purpose, run it on the password pool instead of the event loop
+    return await password_pool.run(pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await password_pool.run(pwd_context.hash, password)
 
-def get_user(username: str):
-    user = db["users"].find_one({"username": username})
+async def get_user(username: str):
+    user = await db["users"].find_one({"username": username})
     if user is not None:
         return user
+
+async def get_cached_user(username: str):
+    user = user_cache.get(username)
+    if user is None:
+        user = await get_user(username)
+        if user is None:
+            return None
+        user_cache.set(username, user)
+    # hand out a copy so handlers cannot change the cached document
+    return dict(user)
+
+def invalidate_user(username: str):
+    # call after anything that changes a user's role, profile or purchases, or deletes the user
+    user_cache.delete(username)
     
-def authenticate_user(username: str, password: str):
-    user = get_user(username)
-    if user is None or not verify_password(password, user['hashed_password']):
+async def authenticate_user(username: str, password: str):
+    user = await get_user(username)
+    if user is None or not await verify_password(password, user['hashed_password']):
         return None  # Return None if user is not found or password is incorrect
     return user
 
@@ -79,7 +101,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
         token_data = TokenData(username=username)
     except jwt.PyJWTError:
         raise credentials_exception
-    user = get_user(username=token_data.username)
+    user = await get_cached_user(username=token_data.username)
     if user is None: 
         raise credentials_exception
     return user
@@ -91,7 +113,7 @@ async def get_current_active_user(current_user: Annotated[User, Depends(get_curr
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
 
     if user is None:
         raise HTTPException(
@@ -0,0 +1,210 @@
+"""Database round trips and latency of the hot routes, against the in-memory backend.
+
+Run with `python -m benchmarks.round_trips`. It seeds a throwaway mongomock database, so it never
+touches Atlas. Round trips come from the per-request command counter behind /metrics, with
+mongomock every call on the database thread pool counts as one command. Latencies are in-process,
+so compare them with each other, not with a deployed server.
+"""
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+
+os.environ["DATABASE_BACKEND"] = "memory"
+# mongomock is not thread safe, one database thread keeps each update atomic the way the server does.
+# requests still interleave at every await, which is what the vote storm is checking
+os.environ["DATABASE_THREADS"] = "1"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+import asyncio
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from auth import create_access_token
+from database import db
+from metrics import RequestDatabase, _request_database, metrics
+from votes import UPVOTE, cast_vote
+import main
+
+POSTS = 1000
+COMMENTS = 200
+VOTERS = 100
+REQUESTS = 100
+
+RETAILERS = ["bestbuy", "costco", "walmart", "amazon", "canadiantire"]
+PRODUCTS = ["Nintendo Switch", "Samsung TV", "Dyson vacuum", "AirPods Pro", "Lego set", "Instant Pot"]
+
+
+def headers(username: str):
+    return {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+
+
+def register(client, username: str):
+    response = client.post("/api/v1/users/register",
+                           json={"username": username, "password": "benchmark", "user_email": f"{username}@example.com"})
+    assert response.status_code == 200, response.text
+
+
+def run(method: str, route: str, calls, expected_status: int = 200, workers: int = 1):
+    # make the requests, returns the round trips per request and the latencies in ms
+    route_metrics = metrics.routes[(method, route)]
+    count, commands = route_metrics.count, route_metrics.db_commands
+
+    def call(request):
+        started = time.perf_counter()
+        response = request()
+        assert response.status_code == expected_status, response.text
+        return (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(workers) as pool:
+        latencies = list(pool.map(call, calls))
+    return (route_metrics.db_commands - commands) / (route_metrics.count - count), latencies
+
+
+def report(name: str, round_trips: float, latencies: list):
+    latencies = sorted(latencies)
+    p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+    print(f"  {name:<56} {round_trips:5.1f} round trips"
+          f"   p50 {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def seed(client):
+    register(client, "alice")
+    alice = headers("alice")
+    post_ids = []
+    for i in range(POSTS):
+        response = client.post("/api/v1/posts/", headers=alice, json={
+            "post_title": f"{PRODUCTS[i % len(PRODUCTS)]} deal {i}",
+            "post_description": f"{PRODUCTS[(i + 1) % len(PRODUCTS)]} bundle at {RETAILERS[i % len(RETAILERS)]}",
+            "post_retailer": RETAILERS[i % len(RETAILERS)],
+            "post_sale_price": 100 + i % 50,
+        })
+        post_ids.append(response.json()["post_data"]["_id"])
+    for i in range(COMMENTS):
+        client.post(f"/api/v1/{post_ids[0]}/comments", headers=alice, json={"comment_body": f"comment {i}"})
+    return post_ids
+
+
+def listings(client, post_ids: list):
+    # filtered listings and post reads answer from one query pass
+    print("Listings and reads")
+    report("GET /api/v1/posts?username=", *run("GET", "/api/v1/posts", [
+        lambda: client.get("/api/v1/posts", params={"username": "alice"})] * REQUESTS))
+    report("GET /api/v1/posts?username= (no posts, 404)", *run("GET", "/api/v1/posts", [
+        lambda: client.get("/api/v1/posts", params={"username": "bob"})] * REQUESTS, expected_status=404))
+    report("GET /api/v1/comments?username=&post_id=", *run("GET", "/api/v1/comments", [
+        lambda: client.get("/api/v1/comments", params={"username": "alice", "post_id": post_ids[0]})] * REQUESTS))
+    report("GET /api/v1/comments?post_id=&include_total=true", *run("GET", "/api/v1/comments", [
+        lambda: client.get("/api/v1/comments", params={"post_id": post_ids[0], "include_total": True})] * REQUESTS))
+    report("GET /api/v1/posts/{post_id}", *run("GET", "/api/v1/posts/{post_id}", [
+        lambda i=i: client.get(f"/api/v1/posts/{post_ids[i]}") for i in range(REQUESTS)]))
+
+
+def vote_storm(client, post_ids: list):
+    # every voter upvotes the same post at once, then changes their mind, the counts must come out exact
+    print(f"Vote storm, {VOTERS} voters on one post, 16 at a time")
+    post_id = post_ids[1]
+    voters = [headers(f"voter{i}") for i in range(VOTERS)]
+
+    started = time.perf_counter()
+    round_trips, latencies = run("POST", "/api/v1/posts/{post_id}/upvote", [
+        lambda voter=voter: client.post(f"/api/v1/posts/{post_id}/upvote", headers=voter) for voter in voters], workers=16)
+    report("POST /api/v1/posts/{post_id}/upvote", round_trips, latencies)
+    print(f"  {VOTERS / (time.perf_counter() - started):.0f} votes/s")
+
+    report("POST /api/v1/posts/{post_id}/downvote (changed)", *run("POST", "/api/v1/posts/{post_id}/downvote", [
+        lambda voter=voter: client.post(f"/api/v1/posts/{post_id}/downvote", headers=voter) for voter in voters], workers=16))
+
+    post = db["posts"].sync.find_one({"_id": ObjectId(post_id)})
+    print(f"  upvotes {post['post_upvotes']}, downvotes {post['post_downvotes']} (expected 0 and {VOTERS})")
+
+
+async def baseline_upvote(post_id: str, username: str):
+    # the upvote handler before the vote engine: read the post, check its voter arrays in Python, then write
+    post = await db["posts"].find_one({"_id": ObjectId(post_id)})
+    if username in post["users_who_upvoted"] or username in post["users_who_downvoted"]:
+        return
+    await db["posts"].update_one({"_id": ObjectId(post_id)},
+                                 {"$inc": {"post_votes": 1}, "$push": {"users_who_upvoted": username}})
+
+
+async def engine_upvote(post_id: str, username: str):
+    try:
+        await cast_vote("post", post_id, username, UPVOTE)
+    except HTTPException:
+        pass  # the second click of a double click is turned away
+
+
+async def counted(vote, post_id: str, username: str):
+    # one vote in its own context, so its commands are counted on their own
+    database = RequestDatabase()
+    _request_database.set(database)
+    started = time.perf_counter()
+    await vote(post_id, username)
+    return database.commands, (time.perf_counter() - started) * 1000
+
+
+async def storm(vote, post_id: str):
+    # every voter double clicks, both clicks in flight at once
+    started = time.perf_counter()
+    results = await asyncio.gather(*[asyncio.create_task(counted(vote, post_id, f"voter{i}"))
+                                     for i in range(VOTERS) for _ in range(2)])
+    return results, time.perf_counter() - started
+
+
+def vote_engines(client, post_ids: list):
+    # the same storm against the baseline read-check-write and the vote engine, without the HTTP layer
+    print(f"Vote engines, {VOTERS} voters double clicking upvote on one post at once")
+    baseline_id = str(db["posts"].sync.insert_one({"post_author": "alice", "post_votes": 0,
+                                                   "users_who_upvoted": [], "users_who_downvoted": []}).inserted_id)
+    for name, vote, post_id in (("baseline (read, check, write)", baseline_upvote, baseline_id),
+                                ("vote engine (conditional update)", engine_upvote, post_ids[3])):
+        results, seconds = client.portal.call(storm, vote, post_id)
+        report(name, sum(commands for commands, _ in results) / len(results), [latency for _, latency in results])
+        votes = db["posts"].sync.find_one({"_id": ObjectId(post_id)})["post_votes"]
+        print(f"  {len(results) / seconds:.0f} clicks/s, post_votes {votes} (expected {VOTERS})")
+
+
+def search(client):
+    # prefix search reads the indexed post_search_terms, the alternative is an unanchored $regex over every post.
+    # mongomock scans for both, on Atlas only the $regex stays a COLLSCAN, see /admin/traces/{trace_id}?explain=true
+    print(f"Search over {POSTS} posts")
+    report("GET /api/v1/posts/search?prefix=true", *run("GET", "/api/v1/posts/search", [
+        lambda: client.get("/api/v1/posts/search", params={"q": "ninten swi", "prefix": True})] * REQUESTS))
+
+    regex = {"$or": [{"post_title": {"$regex": word, "$options": "i"}} for word in ("ninten", "swi")]}
+    latencies = []
+    for _ in range(REQUESTS):
+        started = time.perf_counter()
+        list(db["posts"].sync.find(regex).sort("_id", -1).limit(20))
+        latencies.append((time.perf_counter() - started) * 1000)
+    report("$regex scan, same words (direct find)", 1, latencies)
+
+
+def creates(client, post_ids: list):
+    # the created document is echoed back, return=representation is the old read after the insert
+    print("Creates")
+    alice = headers("alice")
+    body = {"post_title": "Lego set deal", "post_description": "half price", "post_retailer": "costco", "post_sale_price": 50}
+    for return_ in ("minimal", "representation"):
+        report(f"POST /api/v1/posts/?return={return_}", *run("POST", "/api/v1/posts/", [
+            lambda: client.post("/api/v1/posts/", params={"return": return_}, headers=alice, json=body)] * REQUESTS))
+    for return_ in ("minimal", "representation"):
+        report(f"POST /api/v1/{{post_id}}/comments?return={return_}", *run("POST", "/api/v1/{post_id}/comments", [
+            lambda: client.post(f"/api/v1/{post_ids[2]}/comments", params={"return": return_}, headers=alice,
+                                json={"comment_body": "still available"})] * REQUESTS))
+
+
+if __name__ == "__main__":
+    with TestClient(main.app) as client:
+        post_ids = seed(client)
+        # the voters share alice's user document, registering each would spend the run hashing passwords
+        alice = db["users"].sync.find_one({"username": "alice"}, projection={"_id": 0})
+        db["users"].sync.insert_many([dict(alice, username=f"voter{i}") for i in range(VOTERS)])
+
+        listings(client, post_ids)
+        vote_storm(client, post_ids)
+        vote_engines(client, post_ids)
+        search(client)
+        creates(client, post_ids)
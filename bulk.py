@@ -0,0 +1,38 @@
+from fastapi import status
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+# the most items a single bulk request may carry
+MAX_BULK_ITEMS = 500
+
+
+async def bulk_insert(collection, items: list, model, build_document):
+    # validate each item on its own and insert the valid ones with one insert_many,
+    # returns a result per item in request order and the documents that were inserted
+    results = [None] * len(items)
+    documents = []
+    positions = []
+    for index, item in enumerate(items):
+        try:
+            documents.append(build_document(model.model_validate(item)))
+            positions.append(index)
+        except ValidationError as error:
+            results[index] = {"index": index, "status": status.HTTP_422_UNPROCESSABLE_ENTITY,
+                              "errors": error.errors(include_url=False, include_context=False)}
+
+    # unordered, so one failing document does not stop the rest of the batch
+    failed = {}
+    if documents:
+        try:
+            await collection.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            failed = {write_error["index"]: write_error["errmsg"] for write_error in error.details["writeErrors"]}
+
+    inserted = []
+    for position, (index, document) in enumerate(zip(positions, documents)):
+        if position in failed:
+            results[index] = {"index": index, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "error": failed[position]}
+        else:
+            results[index] = {"index": index, "status": status.HTTP_201_CREATED, "id": str(document["_id"])}
+            inserted.append(document)
+    return results, inserted
@@ -0,0 +1,117 @@
+import os
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire ttl seconds after they are set."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+
+        # mark as most recently used
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+
+        # evict the least recently used entries once the cache is full
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheBackend:
+    """Storage behind a ResponseCache. A shared backend (e.g. Redis) implements these three coroutines."""
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Per-process LRU storage, the default backend."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key):
+        return self._entries.get(key)
+
+    async def set(self, key, value):
+        self._entries.set(key, value)
+
+    async def delete(self, key):
+        self._entries.delete(key)
+
+
+class ResponseCache:
+    """Read-through cache for response bodies that tracks its hit ratio."""
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped on every invalidation, so a value read before one is never stored after it
+        self.generation = 0
+
+    async def get(self, key):
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value, generation: int):
+        # generation is the value of self.generation taken before the data was read
+        if generation == self.generation:
+            await self.backend.set(key, value)
+
+    async def invalidate(self, key):
+        self.invalidations += 1
+        self.generation += 1
+        await self.backend.delete(str(key))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+            "invalidations": self.invalidations,
+        }
+
+
+# rendered GET /posts/{post_id} bodies (the post and its comments), keyed by post id
+POST_CACHE_SIZE = int(os.environ.get("POST_CACHE_SIZE", 1000))
+POST_CACHE_SECONDS = float(os.environ.get("POST_CACHE_SECONDS", 30))
+post_pages = ResponseCache(MemoryCacheBackend(POST_CACHE_SIZE, POST_CACHE_SECONDS))
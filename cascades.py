@@ -0,0 +1,152 @@
+import logging
+import uuid
+from collections import Counter
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from database import db
+from cache import post_pages
+from jobs import JOB_BATCH_SIZE, jobs
+from purchases import reconcile_purchases
+from ranking import increment_and_rescore
+from votes import withdraw_votes
+import stats
+
+# what a deleted post or user leaves behind, cleaned up by background jobs in JOB_BATCH_SIZE batches.
+# each cascade is recorded in PENDING_COLLECTION until it finishes, so one cut short by a restart is resumed.
+# every step reads what is left and deletes it, so a resumed cascade picks up where the last one stopped
+PENDING_COLLECTION = "pending_cascades"
+
+logger = logging.getLogger(__name__)
+
+# tells the processes apart when they resume cascades at startup
+PROCESS_ID = uuid.uuid4().hex
+
+COMMENT_PROJECTION = {"comment_author": 1, "comment_post_id": 1}
+POST_PROJECTION = {"post_views": 1, "post_upvotes": 1, "post_downvotes": 1}
+VOTE_PROJECTION = {"target_type": 1, "target_id": 1, "direction": 1}
+PURCHASE_PROJECTION = {"post_id": 1}
+
+
+async def _batches(collection_name: str, query: dict, projection: dict):
+    # hand out the matching documents a batch at a time, the caller deletes each batch so the next read starts over
+    while True:
+        documents = await db[collection_name].find(query, projection=projection).limit(JOB_BATCH_SIZE).to_list()
+        if not documents:
+            return
+        yield documents
+
+
+async def _delete(collection_name: str, documents: list):
+    result = await db[collection_name].delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+    return result.deleted_count
+
+
+async def comments_removed(comments: list, update_posts: bool = True):
+    # correct the counters that pointed at deleted comments and drop the votes on them, returns the votes dropped
+    votes = await db["votes"].delete_many({"target_type": "comment",
+                                           "target_id": {"$in": [comment["_id"] for comment in comments]}})
+
+    authors = Counter(comment["comment_author"] for comment in comments)
+    await db["users"].bulk_write([UpdateOne({"username": author}, {"$inc": {"user_comment_count": -count}})
+                                  for author, count in authors.items()], ordered=False)
+
+    # comment_post_id is the post's id as a string, the posts are keyed by ObjectId
+    posts = Counter(comment["comment_post_id"] for comment in comments)
+    if update_posts:
+        await db["posts"].bulk_write([UpdateOne({"_id": ObjectId(post_id)},
+                                                increment_and_rescore(post_id, {"post_comments_count": -count}))
+                                      for post_id, count in posts.items()], ordered=False)
+    for post_id in posts:
+        await post_pages.invalidate(post_id)  # drop the cached post page
+
+    stats.record(comment_count=-len(comments))
+    return votes.deleted_count
+
+
+async def delete_post_cascade(job, post_id: str):
+    # the post itself is already deleted, this removes its comments and the votes on both
+    async for comments in _batches("comments", {"comment_post_id": post_id}, COMMENT_PROJECTION):
+        job.advance("comments", await _delete("comments", comments))
+        # the post is gone, so there is no comment count left to correct on it
+        job.advance("votes", await comments_removed(comments, update_posts=False))
+
+    async for votes in _batches("votes", {"target_type": "post", "target_id": ObjectId(post_id)}, {"_id": 1}):
+        job.advance("votes", await _delete("votes", votes))
+
+
+async def delete_user_cascade(job, username: str, deleted_at: ObjectId):
+    # the user document is already deleted, this removes everything they left behind.
+    # deleted_at is an ObjectId taken at the delete, so a new account under the same name keeps its own documents
+    before = {"$lt": deleted_at}
+
+    # their posts, each with its comments and votes. the children go first, so a resumed run still finds the post
+    async for posts in _batches("posts", {"post_author": username, "_id": before}, POST_PROJECTION):
+        for post in posts:
+            await delete_post_cascade(job, str(post["_id"]))
+        job.advance("posts", await _delete("posts", posts))
+        for post in posts:
+            stats.record_post_removed(post)
+            await post_pages.invalidate(post["_id"])  # drop the cached page
+
+    # their comments on other posts
+    async for comments in _batches("comments", {"comment_author": username, "_id": before}, COMMENT_PROJECTION):
+        job.advance("comments", await _delete("comments", comments))
+        job.advance("votes", await comments_removed(comments))
+
+    # their votes, taken back out of the scores they moved
+    async for votes in _batches("votes", {"username": username, "_id": before}, VOTE_PROJECTION):
+        job.advance("votes", await _delete("votes", votes))
+        await withdraw_votes(votes)
+
+    # their purchases, taken back out of the bought counts
+    async for purchases in _batches("purchases", {"username": username, "_id": before}, PURCHASE_PROJECTION):
+        job.advance("purchases", await _delete("purchases", purchases))
+        bought = Counter(purchase["post_id"] for purchase in purchases)
+        await db["posts"].bulk_write([UpdateOne({"_id": ObjectId(post_id)}, {"$inc": {"bought_count": -count}})
+                                      for post_id, count in bought.items()], ordered=False)
+        for post_id in bought:
+            await post_pages.invalidate(post_id)  # the cached page shows the bought count
+
+    # their spending rollups. a rollup first written after the delete belongs to a new account under the same name
+    for collection_name in ("purchase_monthly", "purchase_categories"):
+        await db[collection_name].delete_many({"username": username, "_id": before})
+    # a new account could have added to an old rollup before this ran, its own ledger says what it spent
+    if await db["users"].count_documents({"username": username}, limit=1):
+        await reconcile_purchases(job, username, [])
+
+
+CASCADES = {
+    "delete_post": delete_post_cascade,
+    "delete_user": delete_user_cascade,
+}
+
+
+async def _run_cascade(job, cascade: dict):
+    await CASCADES[cascade["kind"]](job, *cascade["args"])
+    await db[PENDING_COLLECTION].delete_one({"_id": cascade["_id"]})
+
+
+async def submit_cascade(kind: str, target: str, *args):
+    # record the cascade before running it, returns the job admins can follow
+    cascade = {"kind": kind, "target": target, "args": list(args), "owner": PROCESS_ID}
+    await db[PENDING_COLLECTION].insert_one(cascade)
+    return jobs.submit(kind, target, _run_cascade, cascade)
+
+
+async def resume_cascades():
+    # called at startup, runs the cascades a previous process did not finish.
+    # each one is claimed first, so when several processes start together only one of them resumes it
+    resumed = 0
+    try:
+        async for cascade in db[PENDING_COLLECTION].find({"owner": {"$ne": PROCESS_ID}}):
+            claimed = await db[PENDING_COLLECTION].find_one_and_update({"_id": cascade["_id"], "owner": cascade["owner"]},
+                                                                       {"$set": {"owner": PROCESS_ID}})
+            if claimed:
+                jobs.submit(cascade["kind"], cascade["target"], _run_cascade, cascade)
+                resumed += 1
+    except PyMongoError:
+        logger.exception("Could not resume the pending cascades")
+    if resumed:
+        logger.info("Resumed %d cascades", resumed)
+    return resumed
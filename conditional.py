@@ -0,0 +1,35 @@
+import hashlib
+from fastapi import Request, Response, status
+from serialization import JSONResponse, dumps
+
+
+def _tag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def make_etag(content) -> str:
+    # a strong validator from the rendered JSON, identical payloads always get the same tag
+    return _tag(dumps(content).encode("utf-8"))
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def etag_response(request: Request, content, etag: str | None = None, status_code: int = status.HTTP_200_OK) -> Response:
+    # with a known etag a current client gets its 304 before anything is rendered
+    if etag and is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    # otherwise render once, and hash the body that would be sent
+    response = JSONResponse(content=content, status_code=status_code)
+    etag = etag or _tag(response.body)
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return response
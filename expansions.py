@@ -0,0 +1,43 @@
+from fastapi import HTTPException, status
+from database import read_db
+from models import UserOut
+
+# what ?include= can add to each post on a listing page
+POST_INCLUDES = ("author", "comment_count")
+
+# the public profile fields, never the password hash or the purchase history
+AUTHOR_PROJECTION = {"_id": 0, **{field: 1 for field in UserOut.model_fields}}
+
+
+def parse_include(include: str | None):
+    # e.g. include=author,comment_count
+    if not include:
+        return set()
+    requested = {name.strip() for name in include.split(",") if name.strip()}
+    unknown = requested.difference(POST_INCLUDES)
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown include {', '.join(sorted(unknown))}. Use any of: {', '.join(POST_INCLUDES)}.")
+    return requested
+
+
+async def expand_posts(posts: list, include: set):
+    # one batched query per expansion for the whole page, instead of a call per post
+    if "author" in include:
+        usernames = list({post["post_author"] for post in posts})
+        authors = await read_db["users"].find({"username": {"$in": usernames}}, projection=AUTHOR_PROJECTION).to_list()
+        authors = {author["username"]: author for author in authors}
+        for post in posts:
+            post["author"] = authors.get(post["post_author"])  # None if the author was deleted
+
+    if "comment_count" in include:
+        # counted from the comments themselves, so the stored counter cannot be stale
+        pipeline = [
+            {"$match": {"comment_post_id": {"$in": [str(post["_id"]) for post in posts]}}},
+            {"$group": {"_id": "$comment_post_id", "count": {"$sum": 1}}}
+        ]
+        counts = {row["_id"]: row["count"] for row in await read_db["comments"].aggregate(pipeline).to_list()}
+        for post in posts:
+            post["post_comments_count"] = counts.get(str(post["_id"]), 0)
+
+    return posts
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from database import db
+from cache import post_pages
+import stats
+
+logger = logging.getLogger(__name__)
+
+# how often expired deals are moved out of the posts collection, and how many per batch
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get("ARCHIVE_INTERVAL_SECONDS", 300))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+
+# the site's time zone, a post_deal_expiry like "2024-01-31 23:59" is read as a local time there
+DEAL_TIMEZONE = ZoneInfo(os.environ.get("DEAL_TIMEZONE", "America/Toronto"))
+
+# the post_deal_expiry formats we understand, anything else is treated as never expiring
+DATETIME_FORMATS = ["%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"]
+DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y", "%B %d, %Y", "%B %d %Y", "%b %d, %Y", "%b %d %Y"]
+
+_task = None
+
+
+def parse_deal_expiry(text: str | None):
+    # the UTC datetime the deal stops being valid, a bare date lasts until the end of that day in DEAL_TIMEZONE
+    if not text:
+        return None
+    text = text.strip()
+    for date_format in DATETIME_FORMATS:
+        try:
+            return _local_to_utc(datetime.strptime(text, date_format))
+        except ValueError:
+            pass
+    for date_format in DATE_FORMATS:
+        try:
+            return _local_to_utc(datetime.strptime(text, date_format) + timedelta(days=1))
+        except ValueError:
+            pass
+    return None
+
+
+def _local_to_utc(local: datetime):
+    # naive UTC, like every other datetime the posts store
+    return local.replace(tzinfo=DEAL_TIMEZONE).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def exclude_expired(filter_params: dict):
+    # posts without an expiry never expire, the archiver keeps the expired ones few
+    filter_params["post_deal_expires_at"] = {"$not": {"$lte": datetime.utcnow()}}
+    return filter_params
+
+
+async def archive_expired():
+    # move expired deals to archived_posts one batch at a time, so no single write holds up the posts collection
+    archived = 0
+    while True:
+        expired = {"post_deal_expires_at": {"$lte": datetime.utcnow()}}
+        posts = await db["posts"].find(expired).sort("post_deal_expires_at", ASCENDING).limit(ARCHIVE_BATCH_SIZE).to_list()
+        if not posts:
+            return archived
+
+        try:
+            await db["archived_posts"].insert_many(posts, ordered=False)
+        except BulkWriteError as error:
+            # posts copied by a run that stopped before deleting them are already archived
+            if any(write_error["code"] != 11000 for write_error in error.details["writeErrors"]):
+                raise
+
+        # only delete once the copies are safely written
+        await db["posts"].delete_many({"_id": {"$in": [post["_id"] for post in posts]}})
+        for post in posts:
+            stats.record_post_removed(post)
+            await post_pages.invalidate(post["_id"])
+        archived += len(posts)
+
+
+async def _run():
+    while True:
+        try:
+            archived = await archive_expired()
+            if archived:
+                logger.info("Archived %d expired deals", archived)
+        except Exception:
+            # e.g. a database or cache error, the next run tries again
+            logger.exception("Could not archive expired deals")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+
+def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+
+# bcrypt gets its own small pool so a login flood cannot block the event loop or the database threads
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 2))
+
+# how many hashes may wait for a free worker before new ones are turned away
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 64))
+
+
+class PasswordHashPool:
+    """Bounded worker pool for bcrypt work that rejects requests once its queue is full."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    async def run(self, func, *args):
+        # shed load instead of letting every request queue up behind bcrypt
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many password checks in progress. Please try again shortly.",
+                                headers={"Retry-After": "1"})
+
+        submitted_at = time.perf_counter()
+
+        def job():
+            self.wait_seconds += time.perf_counter() - submitted_at
+            return func(*args)
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "running": min(self.pending, self.workers),
+            "queued": max(self.pending - self.workers, 0),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "average_wait_ms": round(self.wait_seconds / self.completed * 1000, 2) if self.completed else 0,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_pool = PasswordHashPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
@@ -0,0 +1,71 @@
+import logging
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# the indexes each collection needs for its hot paths, listings are keyed on _id so it is the trailing key
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("user_role", ASCENDING)], name="user_role"),
+    ],
+    "posts": [
+        IndexModel([("post_author", ASCENDING), ("_id", DESCENDING)], name="post_author_newest"),
+        IndexModel([("post_retailer", ASCENDING), ("_id", DESCENDING)], name="post_retailer_newest"),
+        IndexModel([("post_product_category", ASCENDING), ("_id", DESCENDING)], name="post_product_category_newest"),
+        # the expiry archiver's range read
+        IndexModel([("post_deal_expires_at", ASCENDING)], name="post_deal_expires_at"),
+        # /posts/feed, each sort order is one index range read
+        IndexModel([("post_hot_score", DESCENDING)], name="post_hot_score"),
+        IndexModel([("post_votes", DESCENDING), ("_id", DESCENDING)], name="post_votes_newest"),
+        # /posts/search, ranked full words through the text index and word prefixes through the stored terms
+        IndexModel([("post_title", TEXT), ("post_description", TEXT)], name="post_search_text",
+                   weights={"post_title": 3, "post_description": 1}),
+        IndexModel([("post_search_terms", ASCENDING)], name="post_search_terms"),
+    ],
+    "comments": [
+        IndexModel([("comment_post_id", ASCENDING), ("_id", DESCENDING)], name="comment_post_id_newest"),
+        IndexModel([("comment_author", ASCENDING), ("_id", DESCENDING)], name="comment_author_newest"),
+    ],
+    "purchases": [
+        IndexModel([("username", ASCENDING), ("_id", DESCENDING)], name="purchase_user_newest"),
+        IndexModel([("username", ASCENDING), ("post_id", ASCENDING), ("_id", DESCENDING)], name="purchase_user_post_newest"),
+        # counts a post's purchases when reconcile_purchases rebuilds its bought_count
+        IndexModel([("post_id", ASCENDING)], name="purchase_post"),
+    ],
+    # one rollup document per key, so concurrent upserts from several processes cannot create duplicates
+    "purchase_monthly": [
+        IndexModel([("username", ASCENDING), ("month", ASCENDING)], name="purchase_monthly_unique", unique=True),
+    ],
+    "purchase_categories": [
+        IndexModel([("username", ASCENDING), ("category", ASCENDING)], name="purchase_categories_unique", unique=True),
+    ],
+    "votes": [
+        IndexModel([("target_type", ASCENDING), ("target_id", ASCENDING), ("username", ASCENDING)],
+                   name="vote_target_user_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="vote_username"),
+    ],
+}
+
+
+async def ensure_indexes():
+    # create_indexes is a no-op for indexes that already exist, so this is safe on every startup
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except OperationFailure as error:
+            # e.g. duplicate usernames already stored block the unique index, /stats will list it as missing
+            logger.error("Could not create indexes on %s: %s", collection_name, error)
+
+
+async def missing_indexes():
+    # compare the declared indexes with the ones that exist on the server
+    missing = {}
+    for collection_name, indexes in INDEXES.items():
+        existing = await db[collection_name].index_information()
+        names = [index.document["name"] for index in indexes if index.document["name"] not in existing]
+        if names:
+            missing[collection_name] = names
+    return missing
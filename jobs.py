@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import logging
+import os
+import uuid
+from collections import OrderedDict, defaultdict
+from serialization import utcnow
+
+logger = logging.getLogger(__name__)
+
+# how many jobs run at once, the rest wait their turn
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+
+# how many documents a job touches per round trip, so no single write holds up a collection
+JOB_BATCH_SIZE = int(os.environ.get("JOB_BATCH_SIZE", 500))
+
+# finished jobs kept for the admin progress endpoint
+JOB_HISTORY = int(os.environ.get("JOB_HISTORY", 1000))
+
+# how long shutdown waits for running jobs before cancelling them
+JOB_SHUTDOWN_SECONDS = float(os.environ.get("JOB_SHUTDOWN_SECONDS", 10))
+
+
+class Job:
+    """A background task with progress counters that admins can poll."""
+
+    def __init__(self, kind: str, target: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target = target
+        self.status = "queued"
+        self.progress = defaultdict(int)
+        self.error = None
+        self.created_at = utcnow()
+        self.started_at = None
+        self.finished_at = None
+
+    def advance(self, counter: str, amount: int):
+        # e.g. job.advance("comments", 500) after a batch of comments is deleted
+        self.progress[counter] += amount
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRunner:
+    """Runs jobs on the event loop, a few at a time, and remembers the recent ones."""
+
+    def __init__(self, workers: int, history: int):
+        self.workers = workers
+        self.history = history
+        self._jobs = OrderedDict()
+        self._tasks = set()
+        self._semaphore = None
+
+    def submit(self, kind: str, target: str, func, *args):
+        # func(job, *args) does the work and reports progress on the job
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        job = Job(kind, target)
+        self._jobs[job.id] = job
+        self._forget_old_jobs()
+
+        # a fresh context, so the job's commands are not counted or traced as part of the request that submitted it
+        task = asyncio.create_task(self._run(job, func, *args), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job: Job, func, *args):
+        async with self._semaphore:
+            job.status = "running"
+            job.started_at = utcnow()
+            try:
+                await func(job, *args)
+                job.status = "done"
+            except Exception as error:
+                logger.exception("Job %s (%s %s) failed", job.id, job.kind, job.target)
+                job.status = "failed"
+                job.error = str(error)
+            finally:
+                job.finished_at = utcnow()
+
+    def _forget_old_jobs(self):
+        # drop the oldest finished jobs, running ones are kept however many there are
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.history:
+                return
+            if self._jobs[job_id].status in ("done", "failed"):
+                del self._jobs[job_id]
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def recent(self):
+        # newest first
+        return [job for job in reversed(self._jobs.values())]
+
+    async def stop(self):
+        # give running jobs a moment to finish, a cancelled cascade leaves the rest of its documents behind
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=JOB_SHUTDOWN_SECONDS)
+        for task in list(self._tasks):
+            task.cancel()
+
+
+jobs = JobRunner(JOB_WORKERS, JOB_HISTORY)
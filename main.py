@@ -1,12 +1,24 @@
-from fastapi import FastAPI, status, Request
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse
 import routers.users as users
 import routers.posts as posts
 import routers.comments as comments
 import routers.admin as admin
 import auth
-from database import db
+from indexes import ensure_indexes
+import write_behind
+import stats
+import expiry
+import cascades
+from jobs import jobs
+from hashing import password_pool
+from connection import pool_metrics
+from metrics import MetricsMiddleware, metrics
+from tracing import TracingMiddleware
+from cache import post_pages
+from conditional import etag_response
+from serialization import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 description = """
@@ -94,6 +106,12 @@ app = FastAPI(
 
 templates = Jinja2Templates(directory="templates")
 
+# per-route latency, status codes and database commands, served on /metrics
+app.add_middleware(MetricsMiddleware)
+
+# the MongoDB commands of a sample of requests, served on /admin/traces
+app.add_middleware(TracingMiddleware)
+
 # app.add_middleware(
 #     CORSMiddleware,
 #     allow_origins=["http://127.0.0.1:8080"],
@@ -117,6 +135,51 @@ app.include_router(comments.router, prefix="/api/v1")
 app.include_router(admin.router, prefix="/api/v1")
 
 
+@app.on_event("startup")
+async def create_indexes():
+    # make sure every collection has the indexes its lookups rely on, and list the ones that could not be built
+    await ensure_indexes()
+    await stats.refresh_missing_indexes()
+
+
+@app.on_event("startup")
+async def start_write_behind():
+    # start flushing the buffered counters in the background
+    write_behind.start()
+
+
+@app.on_event("startup")
+async def start_stats_reconciliation():
+    # periodically recompute the /stats totals from the collections
+    stats.start()
+
+
+@app.on_event("startup")
+async def start_deal_archiver():
+    # periodically move expired deals to archived_posts
+    expiry.start()
+
+
+@app.on_event("startup")
+async def resume_pending_cascades():
+    # finish the cascading deletes a previous process was stopped in the middle of
+    await cascades.resume_cascades()
+
+
+@app.on_event("shutdown")
+async def flush_write_behind():
+    # write out every buffered counter before the process exits, the jobs still running add to them
+    stats.stop()
+    expiry.stop()
+    await jobs.stop()
+    await write_behind.stop()
+
+
+@app.on_event("shutdown")
+def stop_password_pool():
+    password_pool.shutdown()
+
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -125,33 +188,60 @@ def read_root():
 @app.get("/stats",
          summary="Read API statistics",
          )
-async def get_metrics():
+async def get_metrics(request: Request,
+                      max_age: float = Query(0, ge=0, description="Optional. Accept totals read up to this many seconds ago")):
+    # the totals are kept up to date by the routers, so this is a single read of the stats document
+    totals = await stats.read_totals(max_age)
+
     metrics = {}
 
     metrics["document_counts"] = {
-        "user_count": db["users"].count_documents({}),
-        "post_count": db["posts"].count_documents({}),
-        "comment_count": db["comments"].count_documents({})
+        "user_count": totals.get("user_count", 0),
+        "post_count": totals.get("post_count", 0),
+        "comment_count": totals.get("comment_count", 0)
     }
 
-    pipeline = [
-        {
-            "$group": {
-                "_id": None,
-                "total_post_views": {"$sum": "$post_views"},
-                "total_post_upvotes": {"$sum": {"$size": {"$ifNull": ["$users_who_upvoted", []]}}},
-                "total_post_downvotes": {"$sum": {"$size": {"$ifNull": ["$users_who_downvoted", []]}}}
-            }
-        }
-    ]
-
-    temp = list(db["posts"].aggregate(pipeline))
-
-    metrics["total_view_count_of_posts"] = temp[0]["total_post_views"] if temp else 0
+    metrics["total_view_count_of_posts"] = totals.get("total_post_views", 0)
 
     metrics["vote_counts"] = {
-        "total_post_upvotes_count": temp[0]["total_post_upvotes"] if temp else 0,
-        "total_post_downvotes_count": temp[0]["total_post_downvotes"] if temp else 0,
+        "total_post_upvotes_count": totals.get("total_post_upvotes", 0),
+        "total_post_downvotes_count": totals.get("total_post_downvotes", 0),
     }
 
-    return JSONResponse(content={"metrics": metrics}, status_code=status.HTTP_200_OK)
+    # declared indexes that were not on the server at the last reconciliation, these lookups fall back to collection scans
+    metrics["missing_indexes"] = totals.get("missing_indexes", {})
+
+    # when the totals were last recomputed from the collections, rendered as UTC like every stored datetime
+    metrics["reconciled_at"] = totals.get("reconciled_at")
+
+    # return the metrics, or a 304 if nothing changed since the client's copy.
+    # the process's own counters change on every request and are served untagged by /stats/runtime
+    return etag_response(request, {"metrics": metrics})
+
+
+@app.get("/stats/runtime",
+         summary="Read runtime statistics",
+         description="Password hashing, database connection pool and post page cache statistics of this process",
+         )
+async def get_runtime_metrics():
+    metrics = {}
+
+    # how the password hashing pool is coping, rejected logins mean it is saturated
+    metrics["password_hashing"] = password_pool.stats()
+
+    # how long requests wait for a MongoDB connection and how long they hold one
+    metrics["database_pool"] = pool_metrics.stats()
+
+    # how often post pages are served from the cache
+    metrics["post_page_cache"] = post_pages.stats()
+
+    return JSONResponse(content={"metrics": metrics})
+
+
+@app.get("/metrics",
+         summary="Read request and database metrics",
+         description="Per-route latency histograms, status codes, in-flight requests and MongoDB command counts in the Prometheus text format",
+         response_class=PlainTextResponse,
+         )
+def get_prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
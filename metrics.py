@@ -0,0 +1,194 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from pymongo import monitoring
+
+# request latency histogram buckets in seconds, Prometheus' defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# requests that matched no route share one label, so random paths cannot grow the metrics without bound
+UNMATCHED_ROUTE = "unmatched"
+
+# the database work of the request being handled, the thread pool copies the context so the
+# command listener sees it from the worker threads too
+_request_database = ContextVar("request_database", default=None)
+
+
+class RouteMetrics:
+    """Latency histogram, status codes and database work for one method and route."""
+
+    __slots__ = ("buckets", "count", "seconds", "statuses", "db_commands", "db_seconds")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.statuses = defaultdict(int)
+        self.db_commands = 0
+        self.db_seconds = 0.0
+
+
+class RequestDatabase:
+    """The database commands one request issued and the time they took."""
+
+    __slots__ = ("commands", "seconds")
+
+    def __init__(self):
+        self.commands = 0
+        self.seconds = 0.0
+
+
+class Metrics:
+    """In-process request and database metrics, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.routes = defaultdict(RouteMetrics)
+        self.in_flight = 0
+        self.commands = defaultdict(int)
+        self.command_seconds = defaultdict(float)
+        self.command_failures = defaultdict(int)
+
+    def observe_request(self, method: str, route: str, status_code: int, seconds: float, database: RequestDatabase):
+        metrics = self.routes[(method, route)]
+        metrics.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        metrics.count += 1
+        metrics.seconds += seconds
+        metrics.statuses[status_code] += 1
+        metrics.db_commands += database.commands
+        metrics.db_seconds += database.seconds
+
+    def observe_command(self, command_name: str, seconds: float, failed: bool = False):
+        # called from the database worker threads, a lost increment under a race only skews the numbers slightly
+        self.commands[command_name] += 1
+        self.command_seconds[command_name] += seconds
+        if failed:
+            self.command_failures[command_name] += 1
+        database = _request_database.get()
+        if database is not None:
+            database.commands += 1
+            database.seconds += seconds
+
+    def render(self):
+        lines = [
+            "# HELP http_requests_in_flight Requests currently being handled.",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        routes = sorted(self.routes.items())
+        for (method, route), metrics in routes:
+            labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {metrics.count}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {metrics.seconds}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {metrics.count}")
+
+        lines += ["# HELP http_responses_total Responses by route and status code.",
+                  "# TYPE http_responses_total counter"]
+        for (method, route), metrics in routes:
+            labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+            for status_code, count in sorted(metrics.statuses.items()):
+                lines.append(f'http_responses_total{{{labels},status="{status_code}"}} {count}')
+
+        lines += ["# HELP http_request_db_commands_total MongoDB commands issued while handling requests, by route.",
+                  "# TYPE http_request_db_commands_total counter"]
+        for (method, route), metrics in routes:
+            lines.append(f'http_request_db_commands_total{{method="{_escape(method)}",route="{_escape(route)}"}} {metrics.db_commands}')
+        lines += ["# HELP http_request_db_seconds_total Time spent in MongoDB commands while handling requests, by route.",
+                  "# TYPE http_request_db_seconds_total counter"]
+        for (method, route), metrics in routes:
+            lines.append(f'http_request_db_seconds_total{{method="{_escape(method)}",route="{_escape(route)}"}} {metrics.db_seconds}')
+
+        # every command, including the ones background tasks issue outside a request
+        lines += ["# HELP mongodb_commands_total MongoDB commands by name.",
+                  "# TYPE mongodb_commands_total counter"]
+        for command_name, count in sorted(self.commands.items()):
+            lines.append(f'mongodb_commands_total{{command="{_escape(command_name)}"}} {count}')
+        lines += ["# HELP mongodb_command_seconds_total Time spent in MongoDB commands by name.",
+                  "# TYPE mongodb_command_seconds_total counter"]
+        for command_name, seconds in sorted(self.command_seconds.items()):
+            lines.append(f'mongodb_command_seconds_total{{command="{_escape(command_name)}"}} {seconds}')
+        lines += ["# HELP mongodb_command_failures_total Failed MongoDB commands by name.",
+                  "# TYPE mongodb_command_failures_total counter"]
+        for command_name, count in sorted(self.command_failures.items()):
+            lines.append(f'mongodb_command_failures_total{{command="{_escape(command_name)}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+# route templates by endpoint, e.g. "/api/v1/posts/{post_id}", filled in as routes are first seen
+_routes = {}
+
+
+def route_template(scope):
+    # the router leaves the matched endpoint in the scope, the template keeps path parameters out of the labels
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return UNMATCHED_ROUTE
+    if endpoint not in _routes:
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                _routes[endpoint] = route.path
+                break
+        else:
+            _routes[endpoint] = UNMATCHED_ROUTE
+    return _routes[endpoint]
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Feeds every MongoDB command's duration into the metrics, and into the current request's totals."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe_command(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.observe_command(event.command_name, event.duration_micros / 1e6, failed=True)
+
+
+command_metrics = CommandMetrics()
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing each request, so the response body is streamed through untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500  # what the client gets if the app fails before starting a response
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        database = RequestDatabase()
+        token = _request_database.set(database)
+        metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            metrics.in_flight -= 1
+            _request_database.reset(token)
+            metrics.observe_request(scope["method"], route_template(scope), status_code, seconds, database)
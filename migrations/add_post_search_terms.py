@@ -0,0 +1,34 @@
+"""Store post_search_terms on posts created before prefix search existed.
+
+Run once with `python -m migrations.add_post_search_terms`. It is safe to run again,
+posts that already have their terms are skipped.
+"""
+from pymongo import UpdateOne
+from database import client
+from search import search_terms
+
+BATCH_SIZE = 500
+
+
+def migrate(database):
+    missing = {"post_search_terms": {"$exists": False}}
+    converted = 0
+
+    while True:
+        posts = list(database["posts"].find(missing, projection={"post_title": 1, "post_description": 1})
+                     .limit(BATCH_SIZE))
+        if not posts:
+            return converted
+
+        database["posts"].bulk_write([
+            UpdateOne({"_id": post["_id"]}, {
+                "$set": {"post_search_terms": search_terms(post.get("post_title"), post.get("post_description"))},
+            })
+            for post in posts
+        ], ordered=False)
+        converted += len(posts)
+
+
+if __name__ == "__main__":
+    converted = migrate(client["rfd-api"])
+    print(f"Stored the search terms of {converted} posts")
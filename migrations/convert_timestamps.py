@@ -0,0 +1,55 @@
+"""Convert post_timestamp, comment_timestamp and user_join_date from strings to BSON dates.
+
+Run once with `python -m migrations.convert_timestamps`. It is safe to run again,
+only fields that are still strings are converted.
+
+Posts and comments were stamped with the server's local time, so they get the UTC
+creation time from their ObjectId instead. Users were stamped with utcnow and are parsed.
+"""
+from datetime import datetime
+from pymongo import UpdateOne
+from database import client
+
+BATCH_SIZE = 500
+
+# collection, field and whether the stored string was already UTC
+FIELDS = [
+    ("posts", "post_timestamp", False),
+    ("comments", "comment_timestamp", False),
+    ("users", "user_join_date", True),
+]
+
+
+def to_datetime(document, field: str, is_utc: bool):
+    if is_utc:
+        try:
+            return datetime.fromisoformat(document[field])
+        except ValueError:
+            pass
+    return document["_id"].generation_time
+
+
+def migrate_field(database, collection_name: str, field: str, is_utc: bool):
+    legacy = {field: {"$type": "string"}}
+    converted = 0
+
+    while True:
+        documents = list(database[collection_name].find(legacy, projection={field: 1}).limit(BATCH_SIZE))
+        if not documents:
+            return converted
+
+        database[collection_name].bulk_write([
+            UpdateOne({"_id": document["_id"]}, {"$set": {field: to_datetime(document, field, is_utc)}})
+            for document in documents
+        ], ordered=False)
+        converted += len(documents)
+
+
+def migrate(database):
+    for collection_name, field, is_utc in FIELDS:
+        converted = migrate_field(database, collection_name, field, is_utc)
+        print(f"Converted {field} of {converted} {collection_name}")
+
+
+if __name__ == "__main__":
+    migrate(client["rfd-api"])
@@ -0,0 +1,81 @@
+"""Move the users_purchases arrays into the purchases ledger and rebuild the spending rollups.
+
+Run once with `python -m migrations.move_purchases_to_ledger`. It is safe to run again,
+users that were already converted no longer have the array and are skipped.
+
+The arrays carry no dates, so migrated purchases have no purchased_at and are rolled up
+under month None. A negative entry, which the old remove route appended, cancels the
+latest earlier purchase of the same deal.
+"""
+from pymongo import UpdateOne
+from database import client
+from purchases import purchase_month
+
+BATCH_SIZE = 100
+
+
+def ledger_entries(user):
+    entries = []
+    for item in user.get("users_purchases", []):
+        if item["product_price"] < 0:
+            # the old remove route, drop the latest matching purchase instead
+            for index in range(len(entries) - 1, -1, -1):
+                if entries[index]["post_id"] == item["deal_id"]:
+                    del entries[index]
+                    break
+            continue
+        entries.append({
+            "username": user["username"],
+            "post_id": item["deal_id"],
+            "product_title": item["product_title"],
+            "product_price": item["product_price"],
+            "product_category": None,
+            "purchased_at": None,
+            "migrated": True
+        })
+    return entries
+
+
+def rebuild_rollups(database, username: str):
+    # recount the user's rollups from the whole ledger, so a rerun cannot count anything twice
+    totals = {"purchase_monthly": {}, "purchase_categories": {}}
+    for purchase in database["purchases"].find({"username": username}):
+        keys = {"purchase_monthly": ("month", purchase_month(purchase)),
+                "purchase_categories": ("category", purchase.get("product_category"))}
+        for collection_name, key in keys.items():
+            rollup = totals[collection_name].setdefault(key, {"total": 0, "count": 0})
+            rollup["total"] += purchase["product_price"]
+            rollup["count"] += 1
+
+    for collection_name, rollups in totals.items():
+        database[collection_name].delete_many({"username": username})
+        if rollups:
+            database[collection_name].bulk_write([
+                UpdateOne({"username": username, field: value}, {"$set": rollup}, upsert=True)
+                for (field, value), rollup in rollups.items()
+            ], ordered=False)
+
+
+def migrate(database):
+    legacy = {"users_purchases": {"$exists": True}}
+    converted = 0
+
+    while True:
+        users = list(database["users"].find(legacy, projection={"username": 1, "users_purchases": 1}).limit(BATCH_SIZE))
+        if not users:
+            return converted
+
+        for user in users:
+            # replace the entries an interrupted run may have written, then drop the array
+            database["purchases"].delete_many({"username": user["username"], "migrated": True})
+            entries = ledger_entries(user)
+            if entries:
+                database["purchases"].insert_many(entries)
+            rebuild_rollups(database, user["username"])
+            database["users"].update_one({"_id": user["_id"]}, {"$unset": {"users_purchases": ""}})
+        converted += len(users)
+
+
+if __name__ == "__main__":
+    converted = migrate(client["rfd-api"])
+    print(f"Moved the purchases of {converted} users into the ledger")
@@ -0,0 +1,55 @@
+"""Move the users_who_upvoted/users_who_downvoted arrays into the votes collection.
+
+Run once with `python -m migrations.move_voters_to_votes`. It is safe to run again,
+documents that were already converted no longer have the arrays and are skipped.
+"""
+from pymongo import UpdateOne
+from database import client
+from votes import DOWNVOTE, TARGETS, UPVOTE, vote_key
+
+BATCH_SIZE = 500
+
+
+def migrate_collection(database, target_type: str):
+    target = TARGETS[target_type]
+    collection = database[target["collection"]]
+    legacy = {"$or": [{"users_who_upvoted": {"$exists": True}}, {"users_who_downvoted": {"$exists": True}}]}
+    converted = 0
+
+    while True:
+        documents = list(collection.find(legacy, projection={"users_who_upvoted": 1, "users_who_downvoted": 1})
+                         .limit(BATCH_SIZE))
+        if not documents:
+            return converted
+
+        votes = []
+        counters = []
+        for document in documents:
+            upvoters = document.get("users_who_upvoted", [])
+            downvoters = document.get("users_who_downvoted", [])
+            for direction, usernames in ((UPVOTE, upvoters), (DOWNVOTE, downvoters)):
+                for username in usernames:
+                    votes.append(UpdateOne(vote_key(target_type, document["_id"], username),
+                                           {"$set": {"direction": direction}}, upsert=True))
+
+            # the net score is already stored, only the per-direction counters are new
+            counters.append(UpdateOne({"_id": document["_id"]}, {
+                "$set": {target["upvotes_field"]: len(upvoters), target["downvotes_field"]: len(downvoters)},
+                "$unset": {"users_who_upvoted": "", "users_who_downvoted": ""},
+            }))
+
+        # write the votes before dropping the arrays, so an interrupted run just picks up the batch again
+        if votes:
+            database["votes"].bulk_write(votes, ordered=False)
+        collection.bulk_write(counters, ordered=False)
+        converted += len(documents)
+
+
+def migrate(database):
+    for target_type in TARGETS:
+        converted = migrate_collection(database, target_type)
+        print(f"Moved voters of {converted} {target_type}s into the votes collection")
+
+
+if __name__ == "__main__":
+    migrate(client["rfd-api"])
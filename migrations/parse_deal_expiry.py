@@ -0,0 +1,33 @@
+"""Parse post_deal_expiry into post_deal_expires_at for posts created before expiry was tracked.
+
+Run once with `python -m migrations.parse_deal_expiry`. It is safe to run again,
+posts that already have post_deal_expires_at are skipped. Expired deals are moved
+to archived_posts by the archiver once the API is running.
+"""
+from pymongo import UpdateOne
+from database import client
+from expiry import parse_deal_expiry
+
+BATCH_SIZE = 500
+
+
+def migrate(database):
+    missing = {"post_deal_expires_at": {"$exists": False}}
+    parsed = 0
+
+    while True:
+        posts = list(database["posts"].find(missing, projection={"post_deal_expiry": 1}).limit(BATCH_SIZE))
+        if not posts:
+            return parsed
+
+        # unparseable or missing expiries are stored as None, the deal never expires
+        database["posts"].bulk_write([
+            UpdateOne({"_id": post["_id"]}, {"$set": {"post_deal_expires_at": parse_deal_expiry(post.get("post_deal_expiry"))}})
+            for post in posts
+        ], ordered=False)
+        parsed += len(posts)
+
+
+if __name__ == "__main__":
+    parsed = migrate(client["rfd-api"])
+    print(f"Parsed the deal expiry of {parsed} posts")
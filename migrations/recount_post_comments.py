@@ -0,0 +1,39 @@
+"""Recount post_comments_count from the comments collection and drop the stray post_comment_count field.
+
+Run once with `python -m migrations.recount_post_comments`. It is safe to run again,
+every run sets the counters from the comments that exist at the time.
+"""
+from pymongo import ASCENDING, UpdateOne
+from database import client
+
+BATCH_SIZE = 500
+
+
+def recount(database):
+    # one pass over the comments for every post's count
+    pipeline = [{"$group": {"_id": "$comment_post_id", "count": {"$sum": 1}}}]
+    counts = {row["_id"]: row["count"] for row in database["comments"].aggregate(pipeline)}
+
+    recounted = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        posts = list(database["posts"].find(query, projection={"_id": 1})
+                     .sort("_id", ASCENDING).limit(BATCH_SIZE))
+        if not posts:
+            return recounted
+
+        database["posts"].bulk_write([
+            UpdateOne({"_id": post["_id"]}, {
+                "$set": {"post_comments_count": counts.get(str(post["_id"]), 0)},
+                "$unset": {"post_comment_count": ""},
+            })
+            for post in posts
+        ], ordered=False)
+        recounted += len(posts)
+        last_id = posts[-1]["_id"]
+
+
+if __name__ == "__main__":
+    recounted = recount(client["rfd-api"])
+    print(f"Recounted the comments of {recounted} posts")
@@ -0,0 +1,30 @@
+"""Compute post_hot_score for posts created before the hot feed existed.
+
+Run once with `python -m migrations.score_posts`. It is safe to run again,
+posts that already have a score are skipped.
+"""
+from pymongo import UpdateOne
+from database import client
+from ranking import hot_score_stage
+
+BATCH_SIZE = 500
+
+
+def migrate(database):
+    missing = {"post_hot_score": {"$exists": False}}
+    scored = 0
+
+    while True:
+        posts = list(database["posts"].find(missing, projection={"_id": 1}).limit(BATCH_SIZE))
+        if not posts:
+            return scored
+
+        # the score is computed on the server from the stored counters
+        database["posts"].bulk_write([UpdateOne({"_id": post["_id"]}, [hot_score_stage(post["_id"])])
+                                      for post in posts], ordered=False)
+        scored += len(posts)
+
+
+if __name__ == "__main__":
+    scored = migrate(client["rfd-api"])
+    print(f"Scored {scored} posts for the hot feed")
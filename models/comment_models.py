@@ -1,4 +1,5 @@
-from typing import Optional, List
+from datetime import datetime
+from typing import Optional
 from pydantic import BaseModel, BeforeValidator
 from typing_extensions import Annotated
 
@@ -13,9 +14,9 @@ class CommentInDB(BaseModel):
     comment_post_id: str
     comment_author: str
     comment_votes: int = 0
-    comment_timestamp: str = None
-    users_who_upvoted: List[str] = []
-    users_who_downvoted: List[str] = []
+    comment_timestamp: datetime | None = None  # UTC
+    comment_upvotes: int = 0
+    comment_downvotes: int = 0
 
 class UpdateComment(BaseModel):
     comment_body: Optional[str] = None
\ No newline at end of file
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Optional, List
 from pydantic import BaseModel, BeforeValidator
 from typing_extensions import Annotated
@@ -29,16 +30,19 @@ class PostInDB(BaseModel):
     post_product_category:  Optional[str] = None
     post_link_to_deal:  Optional[str] = None 
     post_deal_expiry:  Optional[str] = None 
+    post_deal_expires_at: datetime | None = None  # post_deal_expiry read in DEAL_TIMEZONE and stored as UTC, None if it never expires
     post_sale_price:  Optional[int] = None 
     post_retailer:  Optional[str] = None
     post_votes: int = 0  # Initial vote count
-    post_timestamp: str| None = None
+    post_timestamp: datetime | None = None  # UTC
     post_author: str  # Username of the post creator
     post_views: int = 0  # Track how many people viewed the post
     post_comments_count: int = 0  # Number of comments
-    users_who_upvoted: List[str] = []  # Track upvoters
-    users_who_downvoted: List[str] = []  # Track downvoters
+    post_upvotes: int = 0  # Number of upvotes, the voters are kept in the votes collection
+    post_downvotes: int = 0  # Number of downvotes
     bought_count: int = 0  # Track how many people bought the product
+    post_hot_score: float = 0  # Time-decayed engagement, the order of the hot feed
+    post_search_terms: List[str] = []  # Lowercased words of the title and description, for prefix search
     
 
 class PostUpdate(BaseModel):
@@ -1,5 +1,6 @@
+from datetime import datetime
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional
 from pydantic import BaseModel, EmailStr, Field
 
 class CreateUserRequest(BaseModel):
@@ -18,10 +19,9 @@ class User(BaseModel):
     user_reputation: int = 0
     user_post_count: int = 0
     user_comment_count: int = 0
-    user_join_date: str | None = None
+    user_join_date: datetime | None = None  # UTC
     user_role: str = "user"
     user_spent_total: int = 0
-    users_purchases: List[str] = []
 
 class UserUpdate(BaseModel):
     user_email: Optional[EmailStr] = None
@@ -36,6 +36,6 @@ class UserOut(BaseModel):
     user_reputation: int = 0
     user_post_count: int = 0
     user_comment_count: int = 0
-    user_join_date: str = None
+    user_join_date: datetime | None = None
     user_role: str = "user"
     
\ No newline at end of file
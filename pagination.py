@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from bson import ObjectId
+from fastapi import HTTPException, status
+from pymongo import DESCENDING
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def parse_cursor(after: str | None):
+    # the cursor is the _id of the last document on the previous page
+    if after is None:
+        return None
+    if not ObjectId.is_valid(after):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor. Use the next_cursor value from the previous page.")
+    return ObjectId(after)
+
+
+def keyset_filter(filter_params: dict, after: str | None = None):
+    # restrict the filter to documents older than the cursor
+    query = dict(filter_params)
+    cursor_id = parse_cursor(after)
+    if cursor_id is not None:
+        # keep any _id bounds the filter already has, e.g. from created_between
+        bounds = dict(query.get("_id", {}))
+        bounds["$lt"] = min(bounds["$lt"], cursor_id) if "$lt" in bounds else cursor_id
+        query["_id"] = bounds
+    return query
+
+
+def created_between(since: datetime | None = None, until: datetime | None = None):
+    # an ObjectId starts with its creation second, so a time window is an _id range,
+    # which every listing index already ends with and the keyset pages are read along.
+    # the window is widened to whole seconds, since the ObjectId has no finer time
+    bounds = {}
+    if since is not None:
+        bounds["$gte"] = ObjectId.from_datetime(since)
+    if until is not None:
+        if until.microsecond:
+            until += timedelta(seconds=1)
+        bounds["$lt"] = ObjectId.from_datetime(until)
+    return bounds
+
+
+async def paginate(collection, filter_params: dict, limit: int = DEFAULT_PAGE_SIZE, after: str | None = None, projection=None):
+    # newest first, keyed on _id so every page is a bounded index range read no matter how deep it is
+    query = keyset_filter(filter_params, after)
+
+    # ask for one extra document to find out if there is a next page
+    documents = await collection.find(query, projection).sort("_id", DESCENDING).limit(limit + 1).to_list()
+
+    next_cursor = str(documents[limit - 1]["_id"]) if len(documents) > limit else None
+    return documents[:limit], next_cursor
+
+
+async def paginate_with_total(collection, filter_params: dict, limit: int = DEFAULT_PAGE_SIZE, after: str | None = None, projection=None):
+    # same page as paginate, plus the number of documents matching the filter, in a single $facet round trip
+    page_stages = [{"$sort": {"_id": DESCENDING}}, {"$limit": limit + 1}]
+    cursor_id = parse_cursor(after)
+    if cursor_id is not None:
+        page_stages.insert(0, {"$match": {"_id": {"$lt": cursor_id}}})
+    if projection:
+        page_stages.append({"$project": projection})
+
+    pipeline = [
+        {"$match": filter_params},
+        {"$facet": {"documents": page_stages, "total": [{"$count": "count"}]}},
+    ]
+    result = (await collection.aggregate(pipeline).to_list())[0]
+
+    documents = result["documents"]
+    total = result["total"][0]["count"] if result["total"] else 0
+    next_cursor = str(documents[limit - 1]["_id"]) if len(documents) > limit else None
+    return documents[:limit], next_cursor, total
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from collections import defaultdict
+from bson import ObjectId
+from pymongo import DeleteMany, UpdateOne
+from database import db
+from cache import post_pages
+from jobs import jobs
+
+logger = logging.getLogger(__name__)
+
+# the purchase ledger lives in the purchases collection, the counters below are updated with every ledger write
+# and rebuilt from the ledger by reconcile_purchases when one of those updates fails
+
+
+def purchase_month(purchase):
+    # e.g. "2024-05", None for purchases migrated from before the ledger kept dates
+    purchased_at = purchase.get("purchased_at")
+    return purchased_at.strftime("%Y-%m") if purchased_at else None
+
+
+async def record_purchase(purchase, sign: int = 1):
+    # sign=-1 takes a removed purchase back out of every counter.
+    # the four documents live in four collections, so the updates are sent together rather than one after another
+    price = sign * purchase["product_price"]
+    username = purchase["username"]
+    rollup = {"$inc": {"total": price, "count": sign}}
+
+    results = await asyncio.gather(
+        # how many times the post was bought
+        db["posts"].update_one({"_id": ObjectId(purchase["post_id"])}, {"$inc": {"bought_count": sign}}),
+        # the user's running total
+        db["users"].update_one({"username": username}, {"$inc": {"user_spent_total": price}}),
+        # per-user spending rollups, the upsert creates a rollup document the first time its key is seen
+        db["purchase_monthly"].update_one({"username": username, "month": purchase_month(purchase)}, rollup, upsert=True),
+        db["purchase_categories"].update_one({"username": username, "category": purchase.get("product_category")},
+                                             rollup, upsert=True),
+        return_exceptions=True,
+    )
+    await post_pages.invalidate(purchase["post_id"])  # the cached page shows the bought count
+
+    # the ledger entry is already written, so a failed counter update is repaired from it instead of failing the request
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.error("Could not update the purchase counters of %s, rebuilding them from the ledger", username,
+                     exc_info=errors[0])
+        jobs.submit("reconcile_purchases", username, reconcile_purchases, username, [purchase["post_id"]])
+
+
+async def reconcile_purchases(job, username: str, post_ids: list):
+    # rebuild the user's total and rollups, and the bought count of post_ids, from the purchases ledger
+    total = 0
+    by_month = defaultdict(lambda: {"total": 0, "count": 0})
+    by_category = defaultdict(lambda: {"total": 0, "count": 0})
+    purchases = db["purchases"].find({"username": username},
+                                     projection={"product_price": 1, "product_category": 1, "purchased_at": 1})
+    async for batch in purchases.batches():
+        for purchase in batch:
+            price = purchase.get("product_price") or 0
+            total += price
+            for rollup in (by_month[purchase_month(purchase)], by_category[purchase.get("product_category")]):
+                rollup["total"] += price
+                rollup["count"] += 1
+        job.advance("purchases", len(batch))
+
+    await db["users"].update_one({"username": username}, {"$set": {"user_spent_total": total}})
+    for collection_name, key_field, rollups in (("purchase_monthly", "month", by_month),
+                                                ("purchase_categories", "category", by_category)):
+        requests = [UpdateOne({"username": username, key_field: key}, {"$set": rollup}, upsert=True)
+                    for key, rollup in rollups.items()]
+        # rollups whose purchases are all gone
+        requests.append(DeleteMany({"username": username, key_field: {"$nin": list(rollups)}}))
+        await db[collection_name].bulk_write(requests, ordered=False)
+
+    for post_id in post_ids:
+        bought = await db["purchases"].count_documents({"post_id": post_id})
+        await db["posts"].update_one({"_id": ObjectId(post_id)}, {"$set": {"bought_count": bought}})
+        await post_pages.invalidate(post_id)
+        job.advance("posts", 1)
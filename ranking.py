@@ -0,0 +1,43 @@
+import math
+from bson import ObjectId
+
+# how much each kind of engagement counts towards a post's hot score
+VOTE_WEIGHT = 1
+COMMENT_WEIGHT = 2
+VIEW_WEIGHT = 0.01
+
+# a post needs ten times the engagement to rank level with one posted this many seconds later
+HOT_DECAY_SECONDS = 45000
+
+
+def hot_score(created_at: float, votes: int = 0, comments: int = 0, views: int = 0):
+    # log of the engagement plus the creation time, so newer posts win unless older ones are far more popular
+    engagement = votes * VOTE_WEIGHT + comments * COMMENT_WEIGHT + views * VIEW_WEIGHT
+    sign = -1 if engagement < 0 else 1
+    return sign * math.log10(max(abs(engagement), 1)) + created_at / HOT_DECAY_SECONDS
+
+
+def hot_score_stage(post_id):
+    # the same formula as hot_score on the stored counters, the creation time comes from the ObjectId
+    created_at = ObjectId(post_id).generation_time.timestamp()
+    engagement = {"$add": [
+        {"$multiply": [{"$ifNull": ["$post_votes", 0]}, VOTE_WEIGHT]},
+        {"$multiply": [{"$ifNull": ["$post_comments_count", 0]}, COMMENT_WEIGHT]},
+        {"$multiply": [{"$ifNull": ["$post_views", 0]}, VIEW_WEIGHT]},
+    ]}
+    return {"$set": {"post_hot_score": {"$let": {
+        "vars": {"engagement": engagement},
+        "in": {"$add": [
+            {"$multiply": [{"$cond": [{"$lt": ["$$engagement", 0]}, -1, 1]},
+                           {"$log10": {"$max": [{"$abs": "$$engagement"}, 1]}}]},
+            created_at / HOT_DECAY_SECONDS
+        ]}
+    }}}}
+
+
+def increment_and_rescore(post_id, increments: dict):
+    # a pipeline update that applies the increments and rescores the post in the same write
+    return [
+        {"$set": {field: {"$add": [{"$ifNull": [f"${field}", 0]}, amount]} for field, amount in increments.items()}},
+        hot_score_stage(post_id)
+    ]
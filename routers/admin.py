@@ -1,16 +1,25 @@
-from typing import List
-from bson import ObjectId
-from fastapi import APIRouter, Depends, HTTPException, Path, status
-from fastapi.responses import JSONResponse
-from auth import get_current_user
+from typing import List, Literal
+from bson import ObjectId, json_util
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Response, status
+from serialization import JSONResponse
+from auth import get_current_user, invalidate_user
 from database import db
+from cache import post_pages
+import stats
 from models import User
+from jobs import jobs
+from cascades import comments_removed, submit_cascade
+from tracing import explain, tracer
 
 
 router = APIRouter(
     tags=["Admin"],
 )
 
+def trace_response(content):
+    # traced filters hold BSON values such as regexes and ObjectIds, extended JSON renders them all
+    return Response(json_util.dumps(content, json_options=json_util.RELAXED_JSON_OPTIONS), media_type="application/json")
+
 def id_to_string(comment):
     comment["comment_id"] = str(comment["_id"])
     del comment["_id"]
@@ -35,7 +44,7 @@ async def admin(current_user: User = Depends(get_current_user)):
             )
 async def get_admins():
     # Find all users with the role of admin
-    admins = db["users"].find({"user_role": "admin"}, projection={"hashed_password": 0})
+    admins = await db["users"].find({"user_role": "admin"}, projection={"hashed_password": 0}).to_list()
     
     # Convert the ObjectId to a string
     admins = [id_to_string(admin) for admin in admins]
@@ -55,14 +64,15 @@ async def add_admin(username: str = Path(..., description="The username of the u
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
     
     # Find the user in the database
-    user = db["users"].find_one({"username": username})
+    user = await db["users"].find_one({"username": username})
     
     # If the user is not found, raise an HTTPException
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
     # Update the user's role to admin
-    db["users"].update_one({"username": username}, {"$set": {"user_role": "admin"}})
+    await db["users"].update_one({"username": username}, {"$set": {"user_role": "admin"}})
+    invalidate_user(username)  # the new role applies from the next request
     
     # Return a message
     return {"message": f"{username} is now an admin"}
@@ -80,14 +90,15 @@ async def remove_admin(username: str = Path(..., description="The username of th
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
     
     # Find the user in the database
-    user = db["users"].find_one({"username": username})
+    user = await db["users"].find_one({"username": username})
     
     # If the user is not found, raise an HTTPException
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
     # Update the user's role to user
-    db["users"].update_one({"username": username}, {"$set": {"user_role": "user"}})
+    await db["users"].update_one({"username": username}, {"$set": {"user_role": "user"}})
+    invalidate_user(username)  # the new role applies from the next request
     
     # Return a message
     return {"message": f"{username} is no longer an admin"}
@@ -105,15 +116,23 @@ async def delete_user(username: str = Path(..., description="The username of the
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
     
     # Find the user in the database
-    result = db["users"].find_one({"username": username})
+    result = await db["users"].find_one({"username": username})
     if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
     # Delete the user from the database
-    db["users"].delete_one({"username": username})
+    deleted = await db["users"].delete_one({"username": username})
+    invalidate_user(username)  # the user's token stops working from the next request
+    if not deleted.deleted_count:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    stats.record(user_count=-1)
+    
+    # Remove their posts, comments, votes and purchases in the background
+    job = await submit_cascade("delete_user", username, username, ObjectId())
     
     # Return a message
-    return {"message": f"{username} has been deleted"}
+    return JSONResponse(content={"message": f"{username} has been deleted", "job_id": job.id},
+                        status_code=status.HTTP_202_ACCEPTED)
 
 @router.delete("/admin/delete_comment/{comment_id}",
              summary="Delete a comment",
@@ -128,12 +147,15 @@ async def delete_comment(comment_id: str = Path(..., description="The ID of the
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
     
     # Find the comment in the database
-    result = db["comments"].find_one({"_id": ObjectId(comment_id)})
+    result = await db["comments"].find_one({"_id": ObjectId(comment_id)})
     if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
     
     # Delete the comment from the database
-    db["comments"].delete_one({"_id": ObjectId(comment_id)})
+    deleted = await db["comments"].delete_one({"_id": ObjectId(comment_id)})
+    if deleted.deleted_count:
+        # decrement the comment counts of the author and the post, and drop the votes on the comment
+        await comments_removed([result])
     
     # Return a message
     return {"message": f"Comment {comment_id} has been deleted"}
@@ -151,15 +173,24 @@ async def delete_post(post_id: str = Path(..., description="The ID of the post t
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
     
     # Find the post in the database
-    result = db["posts"].find_one({"_id": ObjectId(post_id)})
+    result = await db["posts"].find_one({"_id": ObjectId(post_id)})
     if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
     
     # Delete the post from the database
-    db["posts"].delete_one({"_id": ObjectId(post_id)})
+    deleted = await db["posts"].delete_one({"_id": ObjectId(post_id)})
+    if not deleted.deleted_count:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
+    await db["users"].update_one({"username": result["post_author"]}, {"$inc": {"user_post_count": -1}})
+    stats.record_post_removed(result)
+    await post_pages.invalidate(post_id)  # drop the cached page
+    
+    # Remove its comments and votes in the background
+    job = await submit_cascade("delete_post", post_id, post_id)
     
     # Return a message
-    return {"message": f"Post {post_id} has been deleted"}
+    return JSONResponse(content={"message": f"Post {post_id} has been deleted", "job_id": job.id},
+                        status_code=status.HTTP_202_ACCEPTED)
 
 @router.post("/admin/ban_user/{username}",
                 summary="Ban a user",
@@ -174,14 +205,110 @@ async def ban_user(username: str = Path(..., description="The username of the us
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
     
     # Find the user in the database
-    result = db["users"].find_one({"username": username})
+    result = await db["users"].find_one({"username": username})
     if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
     # Update the user's role to banned
-    db["users"].update_one({"username": username}, {"$set": {"user_role": "banned"}})
+    await db["users"].update_one({"username": username}, {"$set": {"user_role": "banned"}})
+    invalidate_user(username)  # the ban applies from the next request
     
     # Return a message
     return {"message": f"{username} has been banned"}
+
+@router.get("/admin/jobs",
+            summary="List background jobs",
+            description="List the recent background jobs, newest first, with their progress",
+            responses={403: {"description": "You do not have permission to perform this action"}},
+            )
+async def get_jobs(status_filter: Literal["queued", "running", "done", "failed"] | None = Query(None, alias="status", description="Optional. Only jobs in this state"),
+                   current_user: User = Depends(get_current_user)):
+    
+    # Check if the user is an admin
+    if current_user["user_role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+    
+    # The jobs live in memory, so this lists the jobs this process ran
+    return JSONResponse(content=[job.to_dict() for job in jobs.recent() if status_filter in (None, job.status)],
+                        status_code=status.HTTP_200_OK)
+
+@router.get("/admin/jobs/{job_id}",
+            summary="Read a background job",
+            description="Read the status and progress of a background job",
+            responses={403: {"description": "You do not have permission to perform this action"}, 404: {"description": "Job not found"}},
+            )
+async def get_job(job_id: str = Path(..., description="The ID returned by the request that started the job"),
+                  current_user: User = Depends(get_current_user)):
+    
+    # Check if the user is an admin
+    if current_user["user_role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+    
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    
+    return JSONResponse(content=job.to_dict(), status_code=status.HTTP_200_OK)
+
+@router.get("/admin/traces",
+            summary="List traced requests",
+            description="List the recently traced requests, newest first, with their MongoDB command counts. Requests are traced at TRACE_SAMPLE_RATE",
+            responses={403: {"description": "You do not have permission to perform this action"}},
+            )
+async def get_traces(route: str | None = Query(None, description="Optional. Only requests to this route template, e.g. /api/v1/posts"),
+                     min_duration_ms: float = Query(0, ge=0, description="Optional. Only requests at least this slow"),
+                     limit: int = Query(50, ge=1, le=200, description="The most traces to return"),
+                     current_user: User = Depends(get_current_user)):
+    
+    # Check if the user is an admin
+    if current_user["user_role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+    
+    traces = [trace.to_dict(commands=False) for trace in reversed(tracer.traces)
+              if trace.duration_ms is not None and trace.duration_ms >= min_duration_ms and route in (None, trace.route)]
+    
+    return trace_response(traces[:limit])
+
+@router.get("/admin/traces/{trace_id}",
+            summary="Read a traced request",
+            description="Read every MongoDB command a traced request issued, with its filter, duration and documents returned",
+            responses={403: {"description": "You do not have permission to perform this action"}, 404: {"description": "Trace not found"}},
+            )
+async def get_trace(trace_id: str = Path(..., description="The ID from the request's X-Trace-Id header"),
+                    explain_commands: bool = Query(False, alias="explain", description="Optional. Explain the commands to find the ones no index served"),
+                    current_user: User = Depends(get_current_user)):
+    
+    # Check if the user is an admin
+    if current_user["user_role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+    
+    trace = tracer.find(trace_id)
+    if not trace:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trace not found")
+    
+    if explain_commands:
+        await explain(db, trace.commands)
+    
+    return trace_response(trace.to_dict())
+
+@router.get("/admin/slow_queries",
+            summary="Read the slow-query log",
+            description="List the recent MongoDB commands slower than TRACE_SLOW_MS, newest first, from every request",
+            responses={403: {"description": "You do not have permission to perform this action"}},
+            )
+async def get_slow_queries(collection: str | None = Query(None, description="Optional. Only commands on this collection"),
+                           limit: int = Query(50, ge=1, le=500, description="The most commands to return"),
+                           explain_commands: bool = Query(True, alias="explain", description="Optional. Explain the commands to find the ones no index served"),
+                           current_user: User = Depends(get_current_user)):
+    
+    # Check if the user is an admin
+    if current_user["user_role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+    
+    commands = [command for command in reversed(tracer.slow_queries) if collection in (None, command.collection)][:limit]
+    
+    # Each command is explained once, later reads reuse the plan
+    if explain_commands:
+        await explain(db, commands)
     
-    
\ No newline at end of file
+    return trace_response([command.to_dict() for command in commands])
@@ -1,11 +1,22 @@
 from datetime import datetime
+from typing import List, Literal
 from auth import get_current_active_user
 from models import CreateCommentRequest, CommentInDB, UpdateComment, User
-from fastapi import APIRouter, Depends, Path, Body, HTTPException, Query, status
+from fastapi import APIRouter, Depends, Path, Body, HTTPException, Query, Request, status
 from bson import ObjectId
-from fastapi.responses import JSONResponse
+from serialization import JSONResponse, utcnow
+from pymongo import DESCENDING
 from pymongo.collection import ReturnDocument
-from database import db
+from database import db, read_db
+from cache import post_pages
+from conditional import etag_response
+import stats
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, created_between, keyset_filter, paginate, paginate_with_total
+from streaming import ndjson_response
+from ranking import increment_and_rescore
+from bulk import MAX_BULK_ITEMS, bulk_insert
+from votes import DOWNVOTE, UPVOTE, cast_vote, get_voters
+from cascades import comments_removed
 
 router = APIRouter(
     tags=['Comments'],
@@ -18,6 +29,19 @@ def id_to_string(comment):
     return comment
 
 
+def build_comment(new_comment: CreateCommentRequest, post_id: str, username: str):
+    # the stored form of a new comment, shared by the single and bulk create routes
+    return CommentInDB(
+        comment_body=new_comment.comment_body,
+        comment_post_id=post_id,
+        comment_author=username,
+        comment_votes=0,
+        comment_timestamp=utcnow(),
+        comment_upvotes=0,
+        comment_downvotes=0
+    )
+
+
 @router.post("/{post_id}/comments",
              summary="Create a comment",
              description="Create a comment for the provided post_id",
@@ -29,7 +53,9 @@ def id_to_string(comment):
 async def create_comment(new_comment: CreateCommentRequest,
                          post_id: str = Path(
                              description="The ID of the post you would like to comment on."),
-                         current_user: User = Depends(get_current_active_user)
+                         current_user: User = Depends(get_current_active_user),
+                         return_: Literal["minimal", "representation"] = Query(
+                             "minimal", alias="return", description="Optional. `representation` reads the stored document back from the database instead of echoing what was written.")
                          ):
 
     # check if user is banned
@@ -39,8 +65,8 @@ async def create_comment(new_comment: CreateCommentRequest,
 
     # Check if it is a valid ID
     if ObjectId.is_valid(post_id):
-        # find the post in the database
-        post = db["posts"].find_one({"_id": ObjectId(post_id)})
+        # find the post in the database, only its existence matters
+        post = await db["posts"].find_one({"_id": ObjectId(post_id)}, projection={"_id": 1})
 
         # if post does not exist
         if not post:
@@ -54,30 +80,28 @@ async def create_comment(new_comment: CreateCommentRequest,
                             detail="Invalid post_id format. It must be a valid ID.")  # return an exception
 
     # Cast comment to CommentInDB model
-    new_comment = CommentInDB(
-        comment_body=new_comment.comment_body,
-        comment_post_id=post_id,
-        comment_author=current_user['username'],
-        comment_votes=0,
-        comment_timestamp=str(datetime.now()),
-        users_who_upvoted=[],
-        users_who_downvoted=[]
-    )
+    new_comment = build_comment(new_comment, post_id, current_user['username'])
 
-    # Insert the comment into the database
-    comment_result = db["comments"].insert_one(new_comment.model_dump())
+    # Insert the comment into the database, insert_one adds the new _id to the document
+    created_comment = new_comment.model_dump()
+    comment_result = await db["comments"].insert_one(created_comment)
 
     # If the comment was successfully inserted
     if comment_result.acknowledged:
-        created_comment = db["comments"].find_one(
-            {"_id": comment_result.inserted_id}
-        )
+        # The validated document is what was stored, only read it back when asked to
+        if return_ == "representation":
+            created_comment = await db["comments"].find_one(
+                {"_id": comment_result.inserted_id}
+            )
 
         # Increment the comment count for the user and post
-        db["users"].update_one({"username": current_user["username"]},
-                               {"$inc": {"user_comment_count": 1}})
-        db["posts"].update_one({"_id": ObjectId(post_id)},
-                               {"$inc": {"post_comment_count": 1}})
+        await db["users"].update_one({"username": current_user["username"]},
+                                     {"$inc": {"user_comment_count": 1}})
+        await db["posts"].update_one({"_id": ObjectId(post_id)},
+                                     increment_and_rescore(post_id, {"post_comments_count": 1}))  # also rescores the post for the hot feed
+
+        stats.record(comment_count=1)
+        await post_pages.invalidate(post_id)  # the cached post page is missing the new comment
 
         # Convert the ObjectId to a string
         created_comment['_id'] = str(created_comment['_id'])
@@ -90,6 +114,52 @@ async def create_comment(new_comment: CreateCommentRequest,
                         detail="Comment not created")  # return an exception
 
 
+@router.post("/{post_id}/comments/bulk",
+             summary="Create many comments",
+             description=f"Create up to {MAX_BULK_ITEMS} comments on the provided post_id in one request. Each comment is validated on its own and the response has a result per comment, in request order.",
+             responses={403: {"description": "You are banned from creating comments."}, 404: {
+                 "description": "Post does not exist. Comment must be created for an existing post."}, 400: {"description": "Invalid post_id format. It must be a valid ID."}}
+             )
+async def create_comments_bulk(comments: List[dict] = Body(..., min_length=1, max_length=MAX_BULK_ITEMS,
+                                                           description="The comments to create, each one shaped like the body of Create a comment"),
+                               post_id: str = Path(
+                                   description="The ID of the post you would like to comment on."),
+                               current_user: User = Depends(get_current_active_user)
+                               ):
+
+    # check if user is banned
+    if current_user["user_role"] == "banned":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You are banned from creating posts.")  # return an exception
+
+    # Check if it is a valid ID
+    if not ObjectId.is_valid(post_id):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid post_id format. It must be a valid ID.")  # return an exception
+
+    # the post is looked up once for the whole batch
+    if not await db["posts"].find_one({"_id": ObjectId(post_id)}, projection={"_id": 1}):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Post does not exist. Comment must be created for an existing post.")
+
+    # one insert_many for every valid comment
+    results, inserted = await bulk_insert(db["comments"], comments, CreateCommentRequest,
+                                          lambda comment: build_comment(comment, post_id, current_user["username"]).model_dump())
+
+    # every comment has the same author and post, so each counter moves once for the whole batch
+    if inserted:
+        await db["users"].update_one({"username": current_user["username"]},
+                                     {"$inc": {"user_comment_count": len(inserted)}})
+        await db["posts"].update_one({"_id": ObjectId(post_id)},
+                                     increment_and_rescore(post_id, {"post_comments_count": len(inserted)}))
+        stats.record(comment_count=len(inserted))
+        await post_pages.invalidate(post_id)  # the cached post page is missing the new comments
+
+    return JSONResponse(content={"message": f"{len(inserted)} of {len(comments)} comments created",
+                                 "results": results},
+                        status_code=status.HTTP_200_OK)
+
+
 @router.get("/comments/{comment_id}",
             summary="Read a comment",
             description="Retrive a comment object by the comment_id.",
@@ -97,14 +167,16 @@ async def create_comment(new_comment: CreateCommentRequest,
             responses={404: {"description": "Comment not found."}, 400: {
                 "description": "Invalid comment_id format. It must be a valid ID."}, 200: {"description": "Comment found."}}
             )
-async def get_comment(comment_id: str = Path(description="The ID of the commment you would like to view")):
+async def get_comment(request: Request,
+                      comment_id: str = Path(description="The ID of the commment you would like to view"),
+                      include_voters: bool = Query(False, description="Optional. Include the usernames of the comment's upvoters and downvoters.")):
     # check if it is a valid ID
     if not ObjectId.is_valid(comment_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Invalid comment_id format. It must be a valid ID")  # return an exception
 
     # find the comment in the database
-    comment = db["comments"].find_one({"_id": ObjectId(comment_id)})
+    comment = await db["comments"].find_one({"_id": ObjectId(comment_id)})
 
     # if the comment does not exist, raise an exception
     if not comment:
@@ -112,33 +184,41 @@ async def get_comment(comment_id: str = Path(description="The ID of the commment
             status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found.")
     else:
         comment = id_to_string(comment)  # convert the ObjectId to a string
-        return JSONResponse(content=comment,
-                            status_code=status.HTTP_200_OK)  # return the comment
+
+        # the voter lists are kept in the votes collection, only read them when asked for
+        if include_voters:
+            comment.update(await get_voters("comment", comment_id))
+
+        return etag_response(request, comment)  # return the comment, or a 304 if the client's copy is current
 
 
 @router.get("/comments",
             summary="Read comments with optional filters",
-            description="Retrieve comments with optional filters for username and/or post ID. Leave fields blank to retrive all comments.",
+            description="Retrieve comments with optional filters for username and/or post ID, newest first, one page at a time. Leave fields blank to retrive all comments. Pass the returned next_cursor as `after` to get the next page.",
             responses={200: {"description": "Comments found."}, 404: {"description": "No comments found."}, 400: {
                 "description": "Invalid post_id format. It must be a valid ID."}}
             )
-async def get_comments_filtered(username: str | None = Query(None, description="Optional. The username to filter comments."),
+async def get_comments_filtered(request: Request,
+                                username: str | None = Query(None, description="Optional. The username to filter comments."),
                                 post_id: str | None = Query(
-                                    None, description="Optional. The post ID to filter comments.")
+                                    None, description="Optional. The post ID to filter comments."),
+                                limit: int = Query(
+                                    DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Optional. The number of comments per page."),
+                                after: str | None = Query(
+                                    None, description="Optional. The next_cursor from the previous page."),
+                                stream: bool = Query(
+                                    False, description="Optional. Stream every matching comment as NDJSON instead of a single JSON response."),
+                                include_total: bool = Query(
+                                    False, description="Optional. Also return the number of comments matching the filters."),
+                                since: datetime | None = Query(
+                                    None, description="Optional. Only comments created at or after this time."),
+                                until: datetime | None = Query(
+                                    None, description="Optional. Only comments created before this time.")
                                 ):
     filter_params = {}  # create an empty dictionary for the filter parameters
 
-    # if username is provided
+    # if username is provided, set the username to be a filter parameter
     if username:
-        # find the user in the database
-        user = db["users"].find_one({"username": username})
-
-        # if the user does not exist, raise an exception
-        if not user:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail="User not found.")
-
-        # set the username to be a filter parameter
         filter_params["comment_author"] = username
 
     # if post_id is provided
@@ -148,34 +228,49 @@ async def get_comments_filtered(username: str | None = Query(None, description="
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail="Invalid post_id format. It must be a valid ID.")  # return an exception
 
-        # check if the post exists
-        post = db["posts"].find_one({"_id": ObjectId(post_id)})
+        # set the post_id to be a filter parameter
+        filter_params["comment_post_id"] = str(post_id)
 
-        # if the post does not exist, raise an exception
-        if not post:
+    # if a time window is provided, set it as a range on _id, see created_between
+    if since or until:
+        filter_params["_id"] = created_between(since, until)
+
+    # stream every matching comment, one JSON document per line, for bulk consumers
+    if stream:
+        return ndjson_response(read_db["comments"].find(keyset_filter(filter_params, after)).sort("_id", DESCENDING), id_to_string)
+
+    # get a page of the comments that match the filter parameters, with the total in the same query if asked for
+    content = {}
+    if include_total:
+        comments_result, next_cursor, content["total"] = await paginate_with_total(read_db["comments"], filter_params, limit, after)
+    else:
+        comments_result, next_cursor = await paginate(read_db["comments"], filter_params, limit, after)
+
+    # if there are no comments, look up the filters only now to explain why
+    if not comments_result:
+        if username and not await read_db["users"].find_one({"username": username}, projection={"_id": 1}):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail="User not found.")
+        if post_id and not await read_db["posts"].find_one({"_id": ObjectId(post_id)}, projection={"_id": 1}):
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail="Post not found.")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="No comments found.")
 
-        # set the post_id to be a filter parameter
-        filter_params["comment_post_id"] = str(post_id)
+    # convert the ObjectId to a string for each comment
+    comments_result = [id_to_string(comment) for comment in comments_result]
+    content["next_cursor"] = next_cursor
 
-    # if there are comments that match the filter parameters
-    if db["comments"].count_documents(filter_params) > 0:
-        # find the comments that match the filter parameters
-        comments_result = db["comments"].find(filter_params)
-        comments_result = [id_to_string(comment)
-                           # convert the ObjectId to a string for each comment
-                           for comment in comments_result]
+    # if the user entered filters
+    if filter_params:
+        content[f"Comments for the query {filter_params} "] = comments_result
 
-        # if the user entered filters
-        if filter_params:
-            return JSONResponse(content={f"Comments for the query {filter_params} ": comments_result},
-                                status_code=status.HTTP_200_OK)
+    # if the user did not enter filters return generic message
+    else:
+        content[f"No filters provided. All commnents were returned "] = comments_result
 
-        # if the user did not enter filters return generic message
-        else:
-            return JSONResponse(content={f"No filters provided. All commnents were returned ": comments_result},
-                                status_code=status.HTTP_200_OK)
+    # return the comments, or a 304 if the client's copy is current
+    return etag_response(request, content)
 
 
 @router.put("/comments/{comment_id}",
@@ -194,7 +289,7 @@ async def update_comment(comment_id: str = Path(description="The ID of the comme
                             detail="Invalid comment_id format. It must be a valid ID.")  # return an exception
 
     # find the comment in the database
-    existing_comment = db["comments"].find_one({"_id": ObjectId(comment_id)})
+    existing_comment = await db["comments"].find_one({"_id": ObjectId(comment_id)})
 
     # if the comment does not exist, raise an exception
     if not existing_comment:
@@ -217,12 +312,13 @@ async def update_comment(comment_id: str = Path(description="The ID of the comme
 
     # update the comment in the database if there are valid fields to update
     if len(comment_data) >= 1:
-        update_result = db["comments"].find_one_and_update({"_id": ObjectId(comment_id)},
-                                                           {"$set": comment_data},
-                                                           return_document=ReturnDocument.AFTER,
-                                                           )
+        update_result = await db["comments"].find_one_and_update({"_id": ObjectId(comment_id)},
+                                                                 {"$set": comment_data},
+                                                                 return_document=ReturnDocument.AFTER,
+                                                                 )
         # convert the ObjectId to a string
         if update_result:
+            await post_pages.invalidate(existing_comment["comment_post_id"])  # drop the cached post page
             update_result["_id"] = str(update_result["_id"])
             return JSONResponse(content=update_result,
                                 status_code=status.HTTP_200_OK)  # return the updated comment
@@ -248,8 +344,7 @@ async def delete_comment(comment_id: str = Path(description="The ID of the comme
                             detail="Invalid comment_id format. It must be a valid ID.")
 
     # find the comment in the database
-    existing_comment = db["comments"].find_one({"_id": ObjectId(comment_id)})
-    post_id = existing_comment["_id"]  # get the post_id
+    existing_comment = await db["comments"].find_one({"_id": ObjectId(comment_id)})
 
     # if the comment does not exist, raise an exception
     if not existing_comment:
@@ -262,19 +357,13 @@ async def delete_comment(comment_id: str = Path(description="The ID of the comme
                             detail="You are not authorized to delete this comment.")
 
     # delete the comment from the database
-    result = db["comments"].delete_one({"_id": ObjectId(comment_id)})
+    result = await db["comments"].delete_one({"_id": ObjectId(comment_id)})
 
     # if the comment was successfully deleted
     if result.deleted_count == 1:
 
-        # decrement the comment count for the user
-        db["users"].update_one({"username": current_user["username"]},
-                               {"$inc": {"user_comment_count": -1}}
-                               )
-
-        # decrement the comment count for the [pst]
-        db["posts"].update_one({"_id": post_id},
-                               {"$inc": {"post_comment_count": -1}})
+        # decrement the comment counts of the user and the post, and drop the votes on the comment
+        await comments_removed([existing_comment])
 
         # return a success message
         return JSONResponse(content={"message": f"Comment {comment_id} removed."},
@@ -295,71 +384,17 @@ async def delete_comment(comment_id: str = Path(description="The ID of the comme
              )
 async def upvote_comment(comment_id: str = Path(description="The ID of the commment to upvote"),
                          current_user: User = Depends(get_current_active_user)):
-
     # check if it is a valid ID
     if not ObjectId.is_valid(comment_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Invalid comment_id format. It must be a valid ID")
 
-    user = current_user["username"]  # create an alias
-
-    # find the comment in the database
-    existing_comment = db["comments"].find_one({"_id": ObjectId(comment_id)})
-
-    # if the comment does not exist, raise an exception
-    if not existing_comment:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail="Comment not found.")
-
-    # cannot vote on own comment, so raise an exception
-    if existing_comment["comment_author"] == current_user["username"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="Cannot vote on your own comment!")
-
-    # user not in upvoted and not in downvoted -> add 1 to upvote
-    if user not in existing_comment["users_who_upvoted"] and user not in existing_comment["users_who_downvoted"]:
-        # add 1 to the comment_votes and add the user to the users_who_upvoted array
-        result = db["comments"].update_one(
-            {"_id": ObjectId(comment_id)},
-            {
-                "$inc": {"comment_votes": 1},
-                "$push": {"users_who_upvoted": user}
-            }
-        )
-
-        # if the comment was successfully upvoted, return a success message
-        if result.modified_count == 1:
-            return JSONResponse(content=f"Comment {comment_id} upvoted!",
-                                status_code=status.HTTP_200_OK)
-
-    # user in downvoted and not in upvoted -> remove from down, add to up and add 2 (1 to cancel downvote, 1 for upvote)
-    if user not in existing_comment["users_who_upvoted"] and user in existing_comment["users_who_downvoted"]:
-        # add 2 to the comment_votes, remove the user from the users_who_downvoted array, and add the user to the users_who_upvoted array
-        result = db["comments"].update_one(
-            {"_id": ObjectId(comment_id)},
-            {
-                "$inc": {"comment_votes": 2},
-                "$pull": {"users_who_downvoted": user},
-                "$push": {"users_who_upvoted": user}
-            }
-        )
-
-        # if the comment was successfully upvoted, return a success message
-        if result.modified_count == 1:
-            return JSONResponse(content=f"Comment {comment_id} upvoted!",
-                                status_code=status.HTTP_200_OK)
-
-    # if user already upvoted the comment, raise an exception
-    if user in existing_comment["users_who_upvoted"] and user not in existing_comment["users_who_downvoted"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="You already upvoted this comment!")
-
-    # increment the comment_author's reputation
-    db["users"].update_one(
-        {"username": existing_comment["comment_author"]},
-        {"$inc": {"user_reputation": 1}},
-    )
+    # apply the upvote in one conditional update, this raises if the comment is missing, your own or already upvoted
+    comment = await cast_vote("comment", comment_id, current_user["username"], UPVOTE)
+    await post_pages.invalidate(comment["comment_post_id"])  # the cached post page shows the old score
 
+    return JSONResponse(content=f"Comment {comment_id} upvoted!",
+                        status_code=status.HTTP_200_OK)
 
 @router.post("/comments/{comment_id}/downvote",
              summary="Downvote a comment",
@@ -371,68 +406,14 @@ async def upvote_comment(comment_id: str = Path(description="The ID of the commm
              )
 async def downvote_comment(comment_id: str = Path(description="The ID of the commment to upvote"),
                            current_user: User = Depends(get_current_active_user)):
-    # check if it is a valid ID, else raise an exception
+    # check if it is a valid ID
     if not ObjectId.is_valid(comment_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Invalid comment_id format. It must be a valid ID")
 
-    user = current_user["username"]  # create an alias
-
-    # find the comment in the database
-    existing_comment = db["comments"].find_one({"_id": ObjectId(comment_id)})
-
-    # if the comment does not exist, raise an exception
-    if not existing_comment:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail="Comment not found.")
+    # apply the downvote in one conditional update, this raises if the comment is missing, your own or already downvoted
+    comment = await cast_vote("comment", comment_id, current_user["username"], DOWNVOTE)
+    await post_pages.invalidate(comment["comment_post_id"])  # the cached post page shows the old score
 
-    # cannot vote on own post so raise an exception
-    if existing_comment["comment_author"] == current_user["username"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="Cannot vote on your own post!")
-
-    # user not in upvoted and not in downvoted -> add -1 to votes
-    if user not in existing_comment["users_who_upvoted"] and user not in existing_comment["users_who_downvoted"]:
-
-        # add -1 to the comment_votes and add the user to the users_who_downvoted array
-        result = db["comments"].update_one(
-            {"_id": ObjectId(comment_id)},
-            {
-                "$inc": {"comment_votes": -1},
-                "$push": {"users_who_downvoted": user}
-            }
-        )
-
-        # if the comment was successfully downvoted, return a success message
-        if result.modified_count == 1:
-            return JSONResponse(content=f"Comment {comment_id} downvoted",
-                                status_code=status.HTTP_200_OK)
-
-    # user in upvoted and not in downvoted -> remove from up, add to downvoted and add -2 (1 to downvote, 1 to cancel upvote)
-    if user not in existing_comment["users_who_downvoted"] and user in existing_comment["users_who_upvoted"]:
-
-        # add -2 to the comment_votes, remove the user from the users_who_upvoted array, and add the user to the users_who_downvoted array
-        result = db["comments"].update_one(
-            {"_id": ObjectId(comment_id)},
-            {
-                "$inc": {"comment_votes": -2},
-                "$pull": {"users_who_upvoted": user},
-                "$push": {"users_who_downvoted": user}
-            }
-        )
-
-        # if the comment was successfully downvoted, return a success message
-        if result.modified_count == 1:
-            return JSONResponse(content=f"Comment {comment_id} downvoted.",
-                                status_code=status.HTTP_200_OK)
-
-    # if user already downvoted the comment, raise an exception
-    if user in existing_comment["users_who_downvoted"] and user not in existing_comment["users_who_upvoted"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="You already downvoted this comment!")
-
-    # decrement the comment_author's reputation
-    db["users"].update_one(
-        {"username": existing_comment["comment_author"]},
-        {"$inc": {"user_reputation": -1}},
-    )
+    return JSONResponse(content=f"Comment {comment_id} downvoted.",
+                        status_code=status.HTTP_200_OK)
@@ -1,17 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException, Path, Body, Query, status
+from fastapi import APIRouter, Depends, HTTPException, Path, Body, Query, Request, status
 from auth import get_current_active_user
 from models import PostInDB, PostUpdate, User, CreatePostRequest
-from fastapi.responses import JSONResponse
+from serialization import JSONResponse, utcnow
+from typing import List, Literal
 from bson import ObjectId
+from pymongo import DESCENDING
 from pymongo.collection import ReturnDocument
 from datetime import datetime
-from database import db
+from database import db, read_db
+import stats
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, created_between, keyset_filter, paginate, paginate_with_total
+from streaming import ndjson_response
+from write_behind import post_views
+from cache import post_pages
+from conditional import etag_response, make_etag
+from expansions import expand_posts, parse_include
+from votes import DOWNVOTE, UPVOTE, cast_vote, get_voters
+from ranking import hot_score
+from expiry import exclude_expired, parse_deal_expiry
+from bulk import MAX_BULK_ITEMS, bulk_insert
+from search import MAX_SEARCH_OFFSET, prefix_query, search_terms, text_query
+from cascades import submit_cascade
 
 router = APIRouter(
     prefix='/posts',
     tags=['Posts']
 )
 
+# the sort behind each /posts/feed order, each one matches an index in indexes.py
+FEED_ORDERS = {
+    "hot": [("post_hot_score", DESCENDING)],
+    "top": [("post_votes", DESCENDING), ("_id", DESCENDING)],
+    "new": [("_id", DESCENDING)],
+}
+
+# the feed is paged by offset, so cap how deep a client can page
+MAX_FEED_OFFSET = 1000
+
+# fields every post read leaves out, post_search_terms is only there for prefix matching
+POST_PROJECTION = {"post_search_terms": 0}
+
 # _id is a ObjectId type and we need JSON
 
 
@@ -27,6 +55,30 @@ def id_to_string_comment(comment):
     return comment
 
 
+def build_post(post: CreatePostRequest, username: str):
+    # the stored form of a new post, shared by the single and bulk create routes
+    return PostInDB(
+        post_title=post.post_title,
+        post_description=post.post_description,
+        post_product_category=post.post_product_category,
+        post_link_to_deal=post.post_link_to_deal,
+        post_deal_expiry=post.post_deal_expiry,
+        post_deal_expires_at=parse_deal_expiry(post.post_deal_expiry),
+        post_sale_price=post.post_sale_price,
+        post_retailer=post.post_retailer,
+        post_votes=0,
+        post_timestamp=utcnow(),
+        post_author=username,
+        post_views=0,
+        post_upvotes=0,
+        post_downvotes=0,
+        post_comments_count=0,
+        bought_count=0,
+        post_hot_score=hot_score(datetime.now().timestamp()),
+        post_search_terms=search_terms(post.post_title, post.post_description)
+    )
+
+
 @router.post("/",
              summary="Create a post",
              status_code=status.HTTP_201_CREATED,
@@ -34,7 +86,9 @@ def id_to_string_comment(comment):
              responses={403: {"description": "You are banned from creating posts."}, 500: {"description": "Post not created"}, 200: {"description": "Post created"}}
              )
 async def create_post(post: CreatePostRequest,
-                      current_user: User = Depends(get_current_active_user)):
+                      current_user: User = Depends(get_current_active_user),
+                      return_: Literal["minimal", "representation"] = Query(
+                          "minimal", alias="return", description="Optional. `representation` reads the stored document back from the database instead of echoing what was written")):
 
     # check if user is banned, and if user is banned, raise an exception
     if current_user["user_role"] == "banned":
@@ -42,36 +96,25 @@ async def create_post(post: CreatePostRequest,
                             detail="You are banned from creating posts.")
 
     # Convert CreatePostRequest to PostInDB
-    new_post = PostInDB(
-        post_title=post.post_title,
-        post_description=post.post_description,
-        post_product_category=post.post_product_category,
-        post_link_to_deal=post.post_link_to_deal,
-        post_deal_expiry=post.post_deal_expiry,
-        post_sale_price=post.post_sale_price,
-        post_retailer=post.post_retailer,
-        post_votes=0,
-        post_timestamp=str(datetime.now()),
-        post_author=current_user["username"],
-        post_views=0,
-        users_who_downvoted=[],
-        users_who_upvoted=[],
-        post_comments_count=0,
-        bought_count=0
-    )
+    new_post = build_post(post, current_user["username"])
 
-    # insert the new post into the database
-    post_result = db["posts"].insert_one(new_post.model_dump())
+    # insert the new post into the database, insert_one adds the new _id to the document
+    created_post = new_post.model_dump()
+    post_result = await db["posts"].insert_one(created_post)
 
     # if the post was successfully created, return the post data
     if post_result.acknowledged:
-        created_post = db["posts"].find_one(
-            {"_id": post_result.inserted_id})  # get the post data
+        # the validated document is what was stored, only read it back when asked to
+        if return_ == "representation":
+            created_post = await db["posts"].find_one(
+                {"_id": post_result.inserted_id}, projection=POST_PROJECTION)  # get the post data
+        created_post.pop("post_search_terms", None)  # only stored for prefix matching
         # convert the _id to a string
         created_post['_id'] = str(created_post['_id'])
-        db["users"].update_one({"username": current_user["username"]},
-                               {"$inc": {"user_post_count": 1}}
-                               )  # increment the user's post count
+        stats.record(post_count=1)
+        await db["users"].update_one({"username": current_user["username"]},
+                                     {"$inc": {"user_post_count": 1}}
+                                     )  # increment the user's post count
 
         # return the post data
         return JSONResponse(content={"message": f"Post {created_post['_id']} created",
@@ -82,20 +125,72 @@ async def create_post(post: CreatePostRequest,
                         detail="Post not created")
 
 
+@router.post("/bulk",
+             summary="Create many posts",
+             description=f"Create up to {MAX_BULK_ITEMS} deal threads in one request. Each post is validated on its own and the response has a result per post, in request order.",
+             responses={403: {"description": "You are banned from creating posts."}}
+             )
+async def create_posts_bulk(posts: List[dict] = Body(..., min_length=1, max_length=MAX_BULK_ITEMS,
+                                                     description="The posts to create, each one shaped like the body of Create a post"),
+                            current_user: User = Depends(get_current_active_user)):
+
+    # check if user is banned, and if user is banned, raise an exception
+    if current_user["user_role"] == "banned":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You are banned from creating posts.")
+
+    # one insert_many for every valid post
+    results, inserted = await bulk_insert(db["posts"], posts, CreatePostRequest,
+                                          lambda post: build_post(post, current_user["username"]).model_dump())
+
+    # every post has the same author, so the counters move once for the whole batch
+    if inserted:
+        await db["users"].update_one({"username": current_user["username"]},
+                                     {"$inc": {"user_post_count": len(inserted)}})
+        stats.record(post_count=len(inserted))
+
+    return JSONResponse(content={"message": f"{len(inserted)} of {len(posts)} posts created",
+                                 "results": results},
+                        status_code=status.HTTP_200_OK)
+
+
 @router.get("/",
             summary="Read all posts",
             response_model_by_alias=False,
-            description="Retrive all posts.",
+            description="Retrive all posts, newest first, one page at a time. Pass the returned next_cursor as `after` to get the next page.",
             responses={404: {"description": "Users or Posts not found"}}
             )
-async def get_all_posts():
-    posts = list(db['posts'].find())  # get all posts
+async def get_all_posts(request: Request,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Optional. The number of posts per page"),
+                        after: str = Query(None, description="Optional. The next_cursor from the previous page"),
+                        stream: bool = Query(False, description="Optional. Stream every post as NDJSON instead of returning a page"),
+                        include: str = Query(None, description="Optional. Comma separated expansions for each post on the page: author, comment_count"),
+                        since: datetime = Query(None, description="Optional. Only posts created at or after this time"),
+                        until: datetime = Query(None, description="Optional. Only posts created before this time"),
+                        include_expired: bool = Query(False, description="Optional. Also return deals that have expired but are not archived yet")):
+    include = parse_include(include)
+
+    # a time window is a range on _id, see created_between
+    filter_params = {}
+    if since or until:
+        filter_params["_id"] = created_between(since, until)
+
+    # leave out expired deals unless asked for
+    if not include_expired:
+        exclude_expired(filter_params)
+
+    # stream every post, one JSON document per line, for bulk consumers
+    if stream:
+        return ndjson_response(read_db["posts"].find(keyset_filter(filter_params, after), projection=POST_PROJECTION).sort("_id", DESCENDING), id_to_string)
+
+    posts, next_cursor = await paginate(read_db["posts"], filter_params, limit, after, projection=POST_PROJECTION)  # get a page of posts
 
     # if there are posts, return the posts
     if posts:
+        await expand_posts(posts, include)  # hydrate the whole page at once
         # convert each post's _id to a string
         output = [id_to_string(post) for post in posts]
-        return JSONResponse(content={"posts": output})
+        return etag_response(request, {"posts": output, "next_cursor": next_cursor})
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="No posts found.")  # if there are no posts, raise an exception
@@ -103,25 +198,38 @@ async def get_all_posts():
 
 @router.get("",
             summary="Read posts with filters",
-            description="Retrieve posts with filter for post author.",
+            description="Retrieve posts with filter for post author, newest first, one page at a time. Pass the returned next_cursor as `after` to get the next page.",
             responses={404: {"description": "Users or Posts not found"}}
             )
-async def get_posts_filtered(username: str = Query(None, description="Optional. The post author to filter posts"),
+async def get_posts_filtered(request: Request,
+                             username: str = Query(None, description="Optional. The post author to filter posts"),
                              retailer: str = Query(
                                  None, description="Optional. The retailer to filter posts"),
                              category: str = Query(
-                                 None, description="Optional. The category to filter posts")
+                                 None, description="Optional. The category to filter posts"),
+                             limit: int = Query(
+                                 DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Optional. The number of posts per page"),
+                             after: str = Query(
+                                 None, description="Optional. The next_cursor from the previous page"),
+                             stream: bool = Query(
+                                 False, description="Optional. Stream every matching post as NDJSON instead of returning a page"),
+                             include_total: bool = Query(
+                                 False, description="Optional. Also return the number of posts matching the filters"),
+                             include: str = Query(
+                                 None, description="Optional. Comma separated expansions for each post on the page: author, comment_count"),
+                             since: datetime = Query(
+                                 None, description="Optional. Only posts created at or after this time"),
+                             until: datetime = Query(
+                                 None, description="Optional. Only posts created before this time"),
+                             include_expired: bool = Query(
+                                 False, description="Optional. Also return deals that have expired but are not archived yet")
                              ):
+    include = parse_include(include)
 
     filter_params = {}  # create a dictionary to store the filter parameters
 
-    # if a username is provided, check if the user exists
+    # if a username is provided, add the user to the filter parameters
     if username:
-        user_exists = db["users"].find_one({"username": username})
-        if not user_exists:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail="User not found.")  # if the user does not exist, raise an exception
-        # if the user exists, add the user to the filter parameters
         filter_params["post_author"] = username
 
     # if a retailer is provided, add the retailer to the filter parameters
@@ -132,20 +240,117 @@ async def get_posts_filtered(username: str = Query(None, description="Optional.
     if category:
         filter_params["post_product_category"] = category
 
-    # get the posts that match the filter parameters
-    posts_result = db["posts"].find(filter_params)
+    # if a time window is provided, add it as a range on _id, see created_between
+    if since or until:
+        filter_params["_id"] = created_between(since, until)
+
+    # leave out expired deals unless asked for
+    if not include_expired:
+        exclude_expired(filter_params)
+
+    # stream every matching post, one JSON document per line, for bulk consumers
+    if stream:
+        return ndjson_response(read_db["posts"].find(keyset_filter(filter_params, after), projection=POST_PROJECTION).sort("_id", DESCENDING), id_to_string)
+
+    # get a page of the posts that match the filter parameters, with the total in the same query if asked for
+    content = {}
+    if include_total:
+        posts_result, next_cursor, content["total"] = await paginate_with_total(read_db["posts"], filter_params, limit, after, projection=POST_PROJECTION)
+    else:
+        posts_result, next_cursor = await paginate(read_db["posts"], filter_params, limit, after, projection=POST_PROJECTION)
 
     # if there are no posts that match the filter parameters, raise an exception
-    if db["posts"].count_documents(filter_params) == 0:
+    if not posts_result:
+        # only look up the author when the page is empty, to tell a missing user apart from no posts
+        if username and not await read_db["users"].find_one({"username": username}, projection={"_id": 1}):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail="User not found.")  # if the user does not exist, raise an exception
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="No posts found for the given filters.")
 
-    # convert the _id to a string for each post
-    output = [id_to_string(post) for post in posts_result]
+    # hydrate the whole page at once, then convert the _id to a string for each post
+    await expand_posts(posts_result, include)
+    content["Posts for the query"] = [id_to_string(post) for post in posts_result]
+    content["next_cursor"] = next_cursor
 
-    # return the posts
-    return JSONResponse(content={"Posts for the query": output},
-                        status_code=status.HTTP_200_OK)
+    # return the posts, or a 304 if the client's copy is current
+    return etag_response(request, content)
+
+
+@router.get("/feed",
+            summary="Read the front page",
+            description="Retrieve posts in feed order: `hot` ranks by engagement decayed over time, `top` by votes and `new` by age. Pass the returned next_offset as `offset` to get the next page.",
+            responses={404: {"description": "No posts found"}}
+            )
+async def get_feed(request: Request,
+                   sort: Literal["hot", "top", "new"] = Query("hot", description="Optional. The feed order"),
+                   limit: int = Query(
+                       DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Optional. The number of posts per page"),
+                   offset: int = Query(
+                       0, ge=0, le=MAX_FEED_OFFSET, description="Optional. The next_offset from the previous page"),
+                   include_expired: bool = Query(
+                       False, description="Optional. Also return deals that have expired but are not archived yet")
+                   ):
+    # leave out expired deals unless asked for
+    filter_params = {} if include_expired else exclude_expired({})
+
+    # every order is backed by an index, so a page is one range read with no in-memory sort
+    posts = await read_db["posts"].find(filter_params, projection=POST_PROJECTION).sort(FEED_ORDERS[sort]).skip(offset).limit(limit + 1).to_list()
+
+    if not posts:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="No posts found.")
+
+    # read one extra post to know whether there is a next page
+    next_offset = offset + limit if len(posts) > limit and offset + limit <= MAX_FEED_OFFSET else None
+    output = [id_to_string(post) for post in posts[:limit]]
+    return etag_response(request, {"posts": output, "next_offset": next_offset})
+
+
+@router.get("/search",
+            summary="Search posts",
+            description="Search the title and description of posts. Full words are ranked by relevance, with `prefix` every word only has to start a word of the post and the newest posts come first. Pass the returned next_offset as `offset` to get the next page.",
+            responses={404: {"description": "No posts found"}, 400: {"description": "Search query too short"}}
+            )
+async def search_posts(request: Request,
+                       q: str = Query(..., min_length=1, max_length=200, description="The words to search for"),
+                       prefix: bool = Query(
+                           False, description="Optional. Match the start of words, e.g. 'nint' finds Nintendo"),
+                       limit: int = Query(
+                           DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Optional. The number of posts per page"),
+                       offset: int = Query(
+                           0, ge=0, le=MAX_SEARCH_OFFSET, description="Optional. The next_offset from the previous page"),
+                       include_expired: bool = Query(
+                           False, description="Optional. Also return deals that have expired but are not archived yet")
+                       ):
+    # the stored terms are only used for matching, leave them out of the results
+    projection = dict(POST_PROJECTION)
+
+    if prefix:
+        query = prefix_query(q)
+        if query is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Search words must be at least 2 characters long.")
+        sort = [("_id", DESCENDING)]
+    else:
+        query = text_query(q)
+        projection["score"] = {"$meta": "textScore"}
+        sort = [("score", {"$meta": "textScore"})]
+
+    # leave out expired deals unless asked for
+    if not include_expired:
+        exclude_expired(query)
+
+    # read one extra post to know whether there is a next page
+    posts = await read_db["posts"].find(query, projection=projection).sort(sort).skip(offset).limit(limit + 1).to_list()
+
+    if not posts:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="No posts found for the search.")
+
+    next_offset = offset + limit if len(posts) > limit and offset + limit <= MAX_SEARCH_OFFSET else None
+    output = [id_to_string(post) for post in posts[:limit]]
+    return etag_response(request, {"posts": output, "next_offset": next_offset})
 
 
 @router.get("/{post_id}",
@@ -154,33 +359,55 @@ async def get_posts_filtered(username: str = Query(None, description="Optional.
             description="Retrive a post by the post_id",
             response_model=PostInDB,
             responses={404: {"description": "Post not found"}, 400: {"description": "Invalid post_id format"}})
-async def get_post(post_id: str = Path(title="RS", description="The ID of the post you would like to view"), examples=["60f1b9b3b3b3b3b3b3b3b3b", "60f1b9b3b3b3b3b3b3b3b3b"]):
+async def get_post(request: Request,
+                   post_id: str = Path(title="RS", description="The ID of the post you would like to view"), examples=["60f1b9b3b3b3b3b3b3b3b3b", "60f1b9b3b3b3b3b3b3b3b3b"],
+                   include_voters: bool = Query(False, description="Optional. Include the usernames of the post's upvoters and downvoters")):
     # check if the post_id is a valid ObjectId
     if not ObjectId.is_valid(post_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Invalid post_id format. It must be a valid ID.")
 
-    # find the post by the post_id and increment the post_views by 1
-    post = db["posts"].find_one_and_update({"_id": ObjectId(post_id)},
-                                           {"$inc": {"post_views": 1}})
-    # get the comments for the post
-    comments = db["comments"].find({"comment_post_id": post_id})
+    # serve the post and its comments from the page cache, the write routes invalidate it
+    page = await post_pages.get(post_id)
+
+    if page is None:
+        generation = post_pages.generation
+
+        # find the post by the post_id, the view is counted in the write-behind buffer instead of on every read
+        post = await db["posts"].find_one({"_id": ObjectId(post_id)}, projection=POST_PROJECTION)
+        # get the comments for the post
+        comments = await db["comments"].find({"comment_post_id": post_id}).to_list()
+
+        # new dictionary to store the response data
+        response_data = {}
 
-    # new dictionary to store the response data
-    response_data = {}
+        if post:
+            response_data["post"] = id_to_string(post)  # set the post data
 
-    if post:
-        response_data["post"] = id_to_string(post)  # set the post data
+        # if there are comments, convert the _id to a string for each comment
+        if comments:
+            comments = [id_to_string_comment(comment) for comment in comments]
+            response_data["comments"] = comments  # set the comments data
 
-    # if there are comments, convert the _id to a string for each comment
-    if db["comments"].count_documents({"comment_post_id": post_id}) > 0:
-        comments = [id_to_string_comment(comment) for comment in comments]
-        response_data["comments"] = comments  # set the comments data
+        # the etag is cached with the page, so a revalidation hit costs no hashing
+        page = {"data": response_data, "etag": make_etag({post_id: response_data})}
+        if response_data:
+            await post_pages.set(post_id, page, generation)
 
-    # if there is response data, return the response data
+    response_data, etag = page["data"], page["etag"]
+
+    if "post" in response_data:
+        post_views.add(ObjectId(post_id), "post_views")  # count the view, flushed in batches
+        stats.record(total_post_views=1)
+
+        # the voter lists are kept in the votes collection, only read them when asked for
+        if include_voters:
+            response_data = {**response_data, "post": {**response_data["post"], **await get_voters("post", post_id)}}
+            etag = None
+
+    # if there is response data, return it, or a 304 if the client's copy is current
     if response_data:
-        return JSONResponse(content={post_id: response_data},
-                            status_code=status.HTTP_200_OK)
+        return etag_response(request, {post_id: response_data}, etag)
 
     # if there is no response data, raise an exception
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -205,7 +432,7 @@ async def update_post(post_id: str = Path(description="The ID of the post you wo
                             detail="Invalid post_id format. It must be a valid ID.")
 
     # find the post by the post_id
-    existing_post = db["posts"].find_one({"_id": ObjectId(post_id)})
+    existing_post = await db["posts"].find_one({"_id": ObjectId(post_id)})
     if not existing_post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             # if the post does not exist, raise an exception
@@ -226,15 +453,26 @@ async def update_post(post_id: str = Path(description="The ID of the post you wo
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="No valid fields to update.")
 
+    # keep the parsed expiry in step with the text
+    if "post_deal_expiry" in update_data:
+        update_data["post_deal_expires_at"] = parse_deal_expiry(update_data["post_deal_expiry"])
+
+    # keep the prefix search terms in step with the title and description
+    if "post_title" in update_data or "post_description" in update_data:
+        update_data["post_search_terms"] = search_terms(update_data.get("post_title", existing_post["post_title"]),
+                                                        update_data.get("post_description", existing_post["post_description"]))
+
     # if there are fields to update, update the post
     if len(update_data) >= 1:
-        update_result = db["posts"].find_one_and_update({"_id": ObjectId(post_id)},
-                                                        {"$set": update_data},
-                                                        return_document=ReturnDocument.AFTER,
-                                                        ) # set the updated fields and return the updated document
+        update_result = await db["posts"].find_one_and_update({"_id": ObjectId(post_id)},
+                                                              {"$set": update_data},
+                                                              projection=POST_PROJECTION,
+                                                              return_document=ReturnDocument.AFTER,
+                                                              ) # set the updated fields and return the updated document
         
         # if the post was updated, return the updated post
         if update_result:
+            await post_pages.invalidate(post_id)  # drop the cached page
             update_result["_id"] = str(update_result["_id"]) # set _id to a string
             return JSONResponse(content={f"Post {update_result["_id"]} updated ": update_result},
                                 status_code=status.HTTP_200_OK) # return the updated post
@@ -247,8 +485,8 @@ async def update_post(post_id: str = Path(description="The ID of the post you wo
 @router.delete("/{post_id}",
                summary="Delete a post",
                response_model_by_alias=False,
-               status_code=status.HTTP_204_NO_CONTENT,
-               description="Retrive a user by the username",
+               status_code=status.HTTP_202_ACCEPTED,
+               description="Delete a post by the post_id. Its comments and votes are removed by a background job",
                responses={404: {"description": "Post not found"}, 400: {"description": "Invalid post_id format"}, 403: {
                    "description": "You are not authorized to update this post."}}
                )
@@ -261,7 +499,7 @@ async def delete_post(post_id: str = Path(description="The ID of the post you wo
                             detail="Invalid post_id format. It must be a valid ID.")
 
     # find the post by the post_id
-    existing_post = db["posts"].find_one({"_id": ObjectId(post_id)})
+    existing_post = await db["posts"].find_one({"_id": ObjectId(post_id)})
 
     # if the post does not exist, raise an exception
     if not existing_post:
@@ -274,15 +512,20 @@ async def delete_post(post_id: str = Path(description="The ID of the post you wo
                             detail="You are not authorized to delete this post.") # if the user is not the author of the post, raise an exception
 
     # if the user is the author of the post, delete the post
-    result = db["posts"].delete_one({"_id": ObjectId(post_id)})
+    result = await db["posts"].delete_one({"_id": ObjectId(post_id)})
 
     # if the post was deleted, return a message
     if result.deleted_count == 1:
-        db["users"].update_one({"username": current_user["username"]},
-                               {"$inc": {"user_post_count": -1}}
-                               ) # decrement the user's post count
-        return JSONResponse(content={"message": f"Post {post_id} removed."},
-                            status_code=status.HTTP_200_OK) # return a message
+        await db["users"].update_one({"username": current_user["username"]},
+                                     {"$inc": {"user_post_count": -1}}
+                                     ) # decrement the user's post count
+        stats.record_post_removed(existing_post)
+        await post_pages.invalidate(post_id)  # drop the cached page
+
+        # remove the comments and votes in the background, admins can follow the job's progress
+        job = await submit_cascade("delete_post", post_id, post_id)
+        return JSONResponse(content={"message": f"Post {post_id} removed.", "job_id": job.id},
+                            status_code=status.HTTP_202_ACCEPTED) # return a message
 
 
 @router.post("/{post_id}/upvote",
@@ -300,62 +543,12 @@ async def upvote_post(post_id: str = Path(description="The ID of the post to upv
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Invalid post_id format. It must be a valid ID")
 
-    user = current_user["username"]  # create an alias
+    # apply the upvote in one conditional update, this raises if the post is missing, your own or already upvoted
+    await cast_vote("post", post_id, current_user["username"], UPVOTE)
+    await post_pages.invalidate(post_id)  # the cached page shows the old score
 
-    # find the post by the post_id
-    existing_post = db["posts"].find_one({"_id": ObjectId(post_id)})
-
-    # if the post does not exist, raise an exception
-    if not existing_post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail="Post not found.")
-
-    # Raise exception because you cannot vote on own post
-    if existing_post["post_author"] == current_user["username"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="Cannot vote on your own post!")
-
-    # user not in upvoted and not in downvoted -> add 1 to upvote
-    if user not in existing_post["users_who_upvoted"] and user not in existing_post["users_who_downvoted"]:
-        result = db["posts"].update_one(
-            {"_id": ObjectId(post_id)},
-            {
-                "$inc": {"post_votes": 1},
-                "$push": {"users_who_upvoted": user}
-            }
-        )# add 1 to the post_votes and add the user to the users_who_upvoted array
-        
-        # Return message if upvote was successful
-        if result.modified_count == 1:
-            return JSONResponse(content={"message": f"Post {post_id} upvoted."},
-                                status_code=status.HTTP_200_OK)
-
-    # user in downvoted and not in upvoted -> remove from down, add to up and add 2 (1 to cancel downvote, 1 for upvote)
-    if user not in existing_post["users_who_upvoted"] and user in existing_post["users_who_downvoted"]:
-        result = db["posts"].update_one(
-            {"_id": ObjectId(post_id)},
-            {
-                "$inc": {"post_votes": 2},
-                "$pull": {"users_who_downvoted": user},
-                "$push": {"users_who_upvoted": user}
-            }
-        ) # add 2 to the post_votes, remove the user from the users_who_downvoted array and add the user to the users_who_upvoted array
-        
-        # Return message if upvote was successful
-        if result.modified_count == 1:
-            return JSONResponse(content={"message": f"Post {post_id} upvoted."},
-                                status_code=status.HTTP_200_OK)
-    
-    # if user already upvoted the post, raise an exception
-    if user in existing_post["users_who_upvoted"] and user not in existing_post["users_who_downvoted"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="You already upvoted this post!")
-    
-    # increment the post's author reputation by 1
-    db["users"].update_one(
-        {"username": existing_post["post_author"]},
-        {"$inc": {"user_reputation": 1}},
-    )
+    return JSONResponse(content={"message": f"Post {post_id} upvoted."},
+                        status_code=status.HTTP_200_OK)
 
 @router.post("/{post_id}/downvote",
              summary="Downvote a post",
@@ -372,59 +565,9 @@ async def downvote_post(post_id: str = Path(description="The ID of the post to d
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Invalid post_id format. It must be a valid ID")
 
-    user = current_user["username"]  # create an alias
+    # apply the downvote in one conditional update, this raises if the post is missing, your own or already downvoted
+    await cast_vote("post", post_id, current_user["username"], DOWNVOTE)
+    await post_pages.invalidate(post_id)  # the cached page shows the old score
 
-    # find the post by the post_id
-    existing_post = db["posts"].find_one({"_id": ObjectId(post_id)}) 
-
-    # if the post does not exist, raise an exception
-    if not existing_post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail="Post not found.")
-
-    # cannot vote on own post, so return an exception
-    if existing_post["post_author"] == current_user["username"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="Cannot vote on your own post!")
-
-    # user not in upvoted and not in downvoted -> add -1 to votes
-    if user not in existing_post["users_who_upvoted"] and user not in existing_post["users_who_downvoted"]:
-        result = db["posts"].update_one(
-            {"_id": ObjectId(post_id)},
-            {
-                "$inc": {"post_votes": -1},
-                "$push": {"users_who_downvoted": user}
-            }
-        ) # add -1 to the post_votes and add the user to the users_who_downvoted array
-        
-        # return message if downvote was successful
-        if result.modified_count == 1:
-            return JSONResponse(content={"message": f"Post {post_id} downvoted."},
-                                status_code=status.HTTP_200_OK)
-
-    # user in upvoted and not in downvoted -> remove from up, add to downvoted and add -2 (1 to downvote, 1 to cancel upvote)
-    if user not in existing_post["users_who_downvoted"] and user in existing_post["users_who_upvoted"]:
-        result = db["posts"].update_one(
-            {"_id": ObjectId(post_id)},
-            {
-                "$inc": {"post_votes": -2},
-                "$pull": {"users_who_upvoted": user},
-                "$push": {"users_who_downvoted": user}
-            }
-        ) # add -2 to the post_votes, remove the user from the users_who_upvoted array and add the user to the users_who_downvoted array
-        
-        # return message if downvote was successful
-        if result.modified_count == 1:
-            return JSONResponse(content={"message": f"Post {post_id} downvoted."},
-                                status_code=status.HTTP_200_OK)
-    
-    # if user already downvoted the post, raise an exception
-    if user in existing_post["users_who_downvoted"] and user not in existing_post["users_who_upvoted"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="You already downvoted this post!")
-    
-    # decrement the post's author reputation by 1
-    db["users"].update_one(
-        {"username": existing_post["post_author"]},
-        {"$inc": {"user_reputation": -1}},
-    )
+    return JSONResponse(content={"message": f"Post {post_id} downvoted."},
+                        status_code=status.HTTP_200_OK)
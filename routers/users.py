@@ -1,11 +1,19 @@
-from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Path, Body, status
-from auth import get_current_active_user, get_password_hash
+from typing import Literal
+from fastapi import APIRouter, Depends, HTTPException, Path, Body, Query, Request, status
+from auth import get_current_active_user, get_password_hash, invalidate_user
 from models.user_models import CreateUserRequest, User, UserOut, UserUpdate
 from bson import ObjectId
-from fastapi.responses import JSONResponse
+from serialization import JSONResponse, utcnow
 from pymongo.collection import ReturnDocument
-from database import db
+from pymongo.errors import DuplicateKeyError
+from database import db, read_db
+import stats
+from conditional import etag_response
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate
+from purchases import record_purchase
+from write_behind import user_reputation
+from pymongo import DESCENDING
+from cascades import submit_cascade
 
 router = APIRouter(
     prefix='/users',
@@ -25,17 +33,19 @@ def id_to_string(user):
              description="Create a new user.",
              responses={400: {"description": "Username already exists."}}
              )
-async def create_user(user: CreateUserRequest):
+async def create_user(user: CreateUserRequest,
+                      return_: Literal["minimal", "representation"] = Query(
+                          "minimal", alias="return", description="Optional. `representation` reads the stored document back from the database instead of echoing what was written.")):
     # Check if username already exists
-    existing_user = db["users"].find_one({"username": user.username})
+    existing_user = await db["users"].find_one({"username": user.username})
 
     # If user already exists, raise an error
     if existing_user:
-        return HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Username already registered. Please select another username.")
 
     # Hash password before storing in the database
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
 
     # Cast CreateUserRequest to a dictionary of User
     user_data = User(
@@ -47,19 +57,28 @@ async def create_user(user: CreateUserRequest):
         user_reputation=0,
         user_post_count=0,
         user_comment_count=0,
-        user_join_date=str(datetime.utcnow()),
+        user_join_date=utcnow(),
         user_role="user",
         user_spent_total=0
     ).model_dump()
 
-    # Insert user data into the database
-    user_result = db["users"].insert_one(user_data)
+    # Insert user data into the database, the unique username index catches a concurrent registration
+    try:
+        user_result = await db["users"].insert_one(user_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Username already registered. Please select another username.")
 
-    # Get the created user from the database, exclude the hashed password
-    created_user = db["users"].find_one(
-        {"_id": user_result.inserted_id},
-        projection={"hashed_password": 0}
-    )
+    stats.record(user_count=1)
+
+    # The validated document is what was stored, only read it back when asked to, exclude the hashed password
+    if return_ == "representation":
+        created_user = await db["users"].find_one(
+            {"_id": user_result.inserted_id},
+            projection={"hashed_password": 0}
+        )
+    else:
+        created_user = {key: value for key, value in user_data.items() if key != "hashed_password"}
 
     # Convert ObjectId to string
     created_user["_id"] = str(created_user["_id"])
@@ -75,15 +94,15 @@ async def create_user(user: CreateUserRequest):
             description="Retrive all users.",
             responses={404: {"description": "No Users found."}}
             )
-async def get_all_users():
+async def get_all_users(request: Request):
     # Get all users from the database, do not include the hashed password
-    users = list(db["users"].find(projection={"hashed_password": 0}))
+    users = await read_db["users"].find(projection={"hashed_password": 0}).to_list()
 
     # If users found, return the users
     if users:
         # Convert all ObjectId to string
         output = [id_to_string(user) for user in users]
-        return output
+        return etag_response(request, output)
     else:
         # If no users found, raise an error
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -97,20 +116,20 @@ async def get_all_users():
             responses={403: {"description": "You are not authorized."},
                        404: {"description": "User not found."}}
             )
-async def get_user(current_user: User = Depends(get_current_active_user)):
-    # Get the logged in user from the database, exclude the hashed password
-    existing_user = db["users"].find_one({"username": current_user["username"]},
-                                         projection={"hashed_password": 0})
-
-    # If user exists return data, If user not found, raise an error
-    if existing_user:
-        user = id_to_string(existing_user)  # Convert ObjectId to string
-        return JSONResponse(content=dict(user),
-                            status_code=status.HTTP_200_OK)  # Return the user
-    else:
+async def get_user(request: Request,
+                   current_user: User = Depends(get_current_active_user)):
+    # The cached principal can be a minute behind on the counters, so read the user fresh, exclude the hashed password
+    user = await db["users"].find_one({"username": current_user["username"]}, projection={"hashed_password": 0})
+    if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            # raise an error
-                            detail=f"User '{current_user["username"]}' not found.")
+                            detail="User not found.")
+
+    # include reputation from votes still waiting in the write-behind buffer
+    for field, amount in user_reputation.pending(user["username"]).items():
+        user[field] = user.get(field, 0) + amount
+
+    user = id_to_string(user)  # Convert ObjectId to string
+    return etag_response(request, user)  # Return the user, or a 304 if the client's copy is current
 
 
 @router.get("/{username}",
@@ -119,15 +138,15 @@ async def get_user(current_user: User = Depends(get_current_active_user)):
             description="Retrive a user by the username",
             responses={404: {"description": "User not found."}}
             )
-async def get_user(username: str = Path(description="The username of the user you want to view")):
+async def get_user(request: Request,
+                   username: str = Path(description="The username of the user you want to view")):
     # Get the user by the username, exclude the hashed password
-    user_in_db = db["users"].find_one({"username": username},
-                                      projection={"hashed_password": 0})
+    user_in_db = await read_db["users"].find_one({"username": username},
+                                            projection={"hashed_password": 0})
     # If user not found, raise an error
     if user_in_db:
         user = id_to_string(user_in_db)  # convert ObjectId to string
-        return JSONResponse(content={username: dict(user)},
-                            status_code=status.HTTP_200_OK)
+        return etag_response(request, {username: dict(user)})
 
     # If user not found, raise an error
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -155,12 +174,13 @@ async def update_user(user_data: UserUpdate = Body(..., description="The user da
 
     # If there are fields to update, update the user
     if len(update_data) >= 1:
-        update_result = db["users"].find_one_and_update({"username": current_user["username"]},
-                                                        {"$set": update_data},
-                                                        return_document=ReturnDocument.AFTER,
-                                                        )
+        update_result = await db["users"].find_one_and_update({"username": current_user["username"]},
+                                                              {"$set": update_data},
+                                                              return_document=ReturnDocument.AFTER,
+                                                              )
         # If user not found, raise an error
         if update_result:
+            invalidate_user(current_user["username"])  # drop the cached copy of the old profile
 
             # Convert ObjectId to string
             update_result["_id"] = str(update_result["_id"])
@@ -176,145 +196,144 @@ async def update_user(user_data: UserUpdate = Body(..., description="The user da
 @router.delete("/{username}",
                summary="Delete a user",
                response_model_by_alias=False,
-               status_code=status.HTTP_204_NO_CONTENT,
-               description="Deletes a user by the username.",
+               status_code=status.HTTP_202_ACCEPTED,
+               description="Deletes a user by the username. Their posts, comments, votes and purchases are removed by a background job.",
                responses={403: {"description": "You are not authorized."}, 404: {
                    "description": "User not found."}}
                )
 async def delete_user(username: str = Path(description="The username of the user you want to remove"),
                       current_user: User = Depends(get_current_active_user)):
 
-    # Get the user by the username
-    existing_user = db["users"].find_one({"username": username})
-
-    # If user not found, raise an error
-    if not existing_user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"User {username} not found.")
-
     # If user is not the current user, raise an error
-    if existing_user["username"] != current_user["username"]:
+    if username != current_user["username"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail=f"You are not authorized to delete this user.")
 
     # If user is the current user, delete the user
-    result = db["users"].delete_one({"username": username})
+    result = await db["users"].delete_one({"username": username})
 
     # If user is deleted, return a message
     if result.deleted_count == 1:
-        return JSONResponse(content={"message": f"User {username} removed."},
-                            status_code=status.HTTP_200_OK)
+        invalidate_user(username)  # the user's token stops working from the next request
+        stats.record(user_count=-1)
+
+        # remove what the user left behind in the background, admins can follow the job's progress
+        job = await submit_cascade("delete_user", username, username, ObjectId())
+        return JSONResponse(content={"message": f"User {username} removed.", "job_id": job.id},
+                            status_code=status.HTTP_202_ACCEPTED)
+
+    # If user not found, raise an error
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                        detail=f"User {username} not found.")
 
 
 @router.post("/purchases/{post_id}/add",
              summary="Add a product to the user's bought list",
              status_code=status.HTTP_201_CREATED,
              description="Add a product to the user's bought list.",
-             responses={404: {"description": "Product not found."}, 200: {"description": "Product added to user's bought list."}}
+             responses={404: {"description": "Product not found."}, 400: {"description": "Invalid post_id format."}, 200: {"description": "Product added to user's bought list."}}
              )
 async def bought_product(current_user: User = Depends(get_current_active_user),
                          post_id: str = Path(..., description="The post ID of the product you bought")):
-    
-    # Check if product exists
-    product = db["posts"].find_one({"_id": ObjectId(post_id)})  
+
+    # Check if the post_id is a valid ObjectId
+    if not ObjectId.is_valid(post_id):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid post_id format. It must be a valid ID.")
+
+    # Check if product exists, reading only what the ledger entry needs
+    product = await db["posts"].find_one({"_id": ObjectId(post_id)},
+                                         projection={"post_title": 1, "post_sale_price": 1, "post_product_category": 1})
 
     # If product not found, raise an error
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Product {post_id} not found.")
 
-    # Increment the bought count of the product by 1
-    db["posts"].update_one(
-        {"_id": ObjectId(post_id)},
-        {
-            "$inc": {"bought_count": 1}
-        }
-    )
-
-    # Increment the user's total spending by the product's price and add the product to the user's bought list
-    result = db["users"].update_one(
-        {"username": current_user["username"]},
-        {
-            "$inc": {"user_spent_total": product["post_sale_price"]},
-            "$push": {
-                "users_purchases": {
-                    "deal_id": post_id,
-                    "product_title": product["post_title"],
-                    "product_price": product["post_sale_price"]
-                }
-            }
-        }
-    )
-
-    # If user's purchase is added to profile
-    if result.acknowledged:
-       
-        # Get the current user
-        updated_user = db["users"].find_one(
-            {"username": current_user["username"]})
-
-        # Get the updated user's total spending
-        updated_spent_total = updated_user["user_spent_total"] if updated_user else 0
-        # return a message
-        return JSONResponse(content={"message": f"Added ${product["post_sale_price"]} to {current_user["username"]}'s spending this year's total. Total spent: ${updated_spent_total}"},
-                            status_code=status.HTTP_200_OK)
+    # Record the purchase in the ledger
+    purchase = {
+        "username": current_user["username"],
+        "post_id": post_id,
+        "product_title": product["post_title"],
+        "product_price": product.get("post_sale_price") or 0,
+        "product_category": product.get("post_product_category"),
+        "purchased_at": utcnow()
+    }
+    await db["purchases"].insert_one(purchase)
+
+    # Update the bought count, the user's total and the rollups in the same request
+    await record_purchase(purchase)
+    invalidate_user(current_user["username"])  # the cached user carries the old spending total
+
+    return JSONResponse(content={"message": f"Added ${purchase["product_price"]} to {current_user["username"]}'s spending.",
+                                 "purchase_id": str(purchase["_id"])},
+                        status_code=status.HTTP_200_OK)
 
 
 @router.get("/purchases/total",
             summary="Read the user's bought list",
-            description="Retrive the user's bought list.",
-            responses={404: {"description": "No products bought."}, 200: {"description": "User's purchases to date."}}
+            description="Retrive the user's purchases, newest first, one page at a time. Pass the returned next_cursor as `after` to get the next page.",
+            responses={200: {"description": "User's purchases to date."}}
             )
-async def get_bought_list(current_user: User = Depends(get_current_active_user)):
+async def get_bought_list(request: Request,
+                          current_user: User = Depends(get_current_active_user),
+                          limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Optional. The number of purchases per page"),
+                          after: str = Query(None, description="Optional. The next_cursor from the previous page")):
 
-    # find the user by the username
-    user = db["users"].find_one(
-        {"username": current_user["username"]})
+    # Get a page of the user's purchases from the ledger
+    purchases, next_cursor = await paginate(db["purchases"], {"username": current_user["username"]}, limit, after,
+                                            projection={"username": 0})
 
-    # If user does not exist, raise an error
-    if not user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail="No products bought.")
-    
-    # return the user's bought list and total spending
-    return JSONResponse(content={"message": f"{current_user["username"]}'s purchases to date.",
-                                 "purchases": user["users_purchases"]},
-                        status_code=status.HTTP_200_OK)
+    return etag_response(request, {"message": f"{current_user["username"]}'s purchases to date.",
+                                   "purchases": [id_to_string(purchase) for purchase in purchases],
+                                   "next_cursor": next_cursor})
+
+
+@router.get("/purchases/summary",
+            summary="Read the user's spending summary",
+            description="Retrive the user's total spending, broken down by month and by product category.",
+            responses={200: {"description": "User's spending summary."}}
+            )
+async def get_spending_summary(request: Request,
+                               current_user: User = Depends(get_current_active_user)):
+
+    # The rollups are kept up to date as purchases come in, so this is two small indexed reads
+    rollup_fields = {"_id": 0, "total": 1, "count": 1}
+    by_month = await db["purchase_monthly"].find({"username": current_user["username"]},
+                                                 projection={**rollup_fields, "month": 1}).sort("month", DESCENDING).to_list()
+    by_category = await db["purchase_categories"].find({"username": current_user["username"]},
+                                                       projection={**rollup_fields, "category": 1}).sort("total", DESCENDING).to_list()
+
+    return etag_response(request, {"message": f"{current_user["username"]}'s spending summary.",
+                                   "total_spent": sum(month["total"] for month in by_month),
+                                   "by_month": by_month,
+                                   "by_category": by_category})
 
 
 @router.post("/purchases/{post_id}/remove",
              summary="Remove a product from the user's bought list",
              status_code=status.HTTP_201_CREATED,
-             deprecated=True,
-             description="Remove a product from the user's bought list. CURRENTLY ONLY DECEREMENTS THE BOUGHT COUNT OF THE PRODUCT, AND DOES NOT REMOVE ENTRY.",
+             description="Remove the user's latest purchase of a product from the bought list.",
+             responses={404: {"description": "No purchase of the product found."}, 400: {"description": "Invalid post_id format."}}
              )
 async def remove_product(current_user: User = Depends(get_current_active_user),
                          post_id: str = Path(..., description="The post ID of the product you bought")):
-    product = db["posts"].find_one({"_id": ObjectId(post_id)})
-    if not product:
+
+    # Check if the post_id is a valid ObjectId
+    if not ObjectId.is_valid(post_id):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid post_id format. It must be a valid ID.")
+
+    # Delete the latest ledger entry for this product
+    purchase = await db["purchases"].find_one_and_delete({"username": current_user["username"], "post_id": post_id},
+                                                         sort=[("_id", DESCENDING)])
+    if not purchase:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Product {post_id} not found.")
+                            detail=f"No purchase of product {post_id} found.")
 
-    db["posts"].update_one(
-        {"_id": ObjectId(post_id)},
-        {
-            "$inc": {"bought_count": -1}
-        }
-    )
-
-    result = db["users"].update_one(
-        {"username": current_user["username"]},
-        {
-            "$inc": {"user_spent_total": -product["post_sale_price"]},
-            "$push": {
-                "users_purchases": {
-                    "deal_id": post_id,
-                    "product_title": product["post_title"],
-                    "product_price": -product["post_sale_price"]
-                }
-            }
-        }
-    )
-    if result.acknowledged:
-        return JSONResponse(content={"message": f"Removed ${product["post_sale_price"]} from {current_user["username"]}'s spending this year's total."},
-                            status_code=status.HTTP_200_OK)
+    # Take the purchase back out of the counters, at the price it was bought for
+    await record_purchase(purchase, sign=-1)
+    invalidate_user(current_user["username"])  # the cached user carries the old spending total
+
+    return JSONResponse(content={"message": f"Removed ${purchase["product_price"]} from {current_user["username"]}'s spending."},
+                        status_code=status.HTTP_200_OK)
@@ -20,7 +20,9 @@ def list_serial_user(users):
 def individual_serial_post(post):
     post_counts =  {"post_votes": post.get("post_votes", 0),
         "post_views": post.get("post_views", 0),
-        "post_comments_count": post.get("post_comments_count", 0)
+        "post_comments_count": post.get("post_comments_count", 0),
+        "post_upvotes": post.get("post_upvotes", 0),
+        "post_downvotes": post.get("post_downvotes", 0)
     }
 
     return {
@@ -33,9 +35,7 @@ def individual_serial_post(post):
             "post_product_discount": post.get("post_product_discount", ""),
             "post_timestamp": post.get("post_timestamp", ""),
             "post_author": post.get("post_author", ""),
-            "post_counts": post_counts,
-            "users_who_upvoted": post.get("users_who_upvoted",[]),
-            "users_who_downvoted": post.get("users_who_downvoted", [])
+            "post_counts": post_counts
     }
 
 def list_serial_post(posts) -> list:
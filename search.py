@@ -0,0 +1,31 @@
+import re
+
+# ranked results are paged by offset, so cap how deep a client can page
+MAX_SEARCH_OFFSET = 1000
+
+# terms shorter than this are too common to be worth a prefix lookup
+MIN_PREFIX_LENGTH = 2
+
+_WORD = re.compile(r"\w+")
+
+
+def search_terms(*texts):
+    # the lowercased words of the title and description, stored on the post for prefix matching
+    terms = set()
+    for text in texts:
+        if text:
+            terms.update(_WORD.findall(text.lower()))
+    return sorted(terms)
+
+
+def text_query(q: str):
+    # full words, ranked by the text index's relevance score
+    return {"$text": {"$search": q}}
+
+
+def prefix_query(q: str):
+    # every word of the query must start a word of the post, each one an anchored range scan on post_search_terms
+    terms = [term for term in search_terms(q) if len(term) >= MIN_PREFIX_LENGTH]
+    if not terms:
+        return None
+    return {"$and": [{"post_search_terms": re.compile("^" + re.escape(term))} for term in terms]}
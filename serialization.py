@@ -0,0 +1,33 @@
+import json
+from datetime import datetime, timezone
+from bson import ObjectId
+from fastapi.responses import JSONResponse as BaseJSONResponse
+
+
+def utcnow():
+    # BSON dates keep milliseconds, so an echoed document matches the stored one
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def json_default(value):
+    # BSON values JSON has no type for, only called for values json cannot encode itself
+    if isinstance(value, datetime):
+        # stored datetimes are UTC, pymongo hands them back without a timezone
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> str:
+    return json.dumps(content, default=json_default, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+
+class JSONResponse(BaseJSONResponse):
+    """JSONResponse that also renders the datetimes and ObjectIds read from MongoDB."""
+
+    def render(self, content) -> bytes:
+        return dumps(content).encode("utf-8")
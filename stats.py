@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from pymongo.errors import PyMongoError
+from database import db, read_db
+from indexes import missing_indexes
+from write_behind import IncrementBuffer
+
+logger = logging.getLogger(__name__)
+
+# how often the running totals are recomputed from the real collections to correct any drift
+STATS_RECONCILE_SECONDS = float(os.environ.get("STATS_RECONCILE_SECONDS", 3600))
+
+TOTALS_ID = "totals"
+TOTAL_FIELDS = ["user_count", "post_count", "comment_count",
+                "total_post_views", "total_post_upvotes", "total_post_downvotes"]
+
+# the routers report events here, they reach the stats document with the other write-behind counters
+counters = IncrementBuffer("stats", upsert=True)
+
+# last totals read from the database, with the time they were read
+_snapshot = None
+_snapshot_at = 0.0
+_task = None
+
+
+def record(**deltas):
+    # e.g. record(post_count=1) when a post is created
+    for field, amount in deltas.items():
+        if amount:
+            counters.add(TOTALS_ID, field, amount)
+
+
+async def reconcile():
+    # write out buffered events first so they are not added on top of the fresh counts
+    await counters.flush()
+
+    totals = {
+        "user_count": await db["users"].count_documents({}),
+        "post_count": await db["posts"].count_documents({}),
+        "comment_count": await db["comments"].count_documents({}),
+    }
+
+    pipeline = [
+        {
+            "$group": {
+                "_id": None,
+                "total_post_views": {"$sum": "$post_views"},
+                "total_post_upvotes": {"$sum": "$post_upvotes"},
+                "total_post_downvotes": {"$sum": "$post_downvotes"}
+            }
+        }
+    ]
+    temp = await db["posts"].aggregate(pipeline).to_list()
+    for field in ["total_post_views", "total_post_upvotes", "total_post_downvotes"]:
+        totals[field] = temp[0][field] if temp else 0
+
+    totals["missing_indexes"] = await missing_indexes()
+    totals["reconciled_at"] = datetime.utcnow()
+
+    await db["stats"].update_one({"_id": TOTALS_ID}, {"$set": totals}, upsert=True)
+
+
+async def read_totals(max_age: float = 0):
+    # serve the last read if it is fresh enough, otherwise one find_one on the stats document
+    global _snapshot, _snapshot_at
+    if _snapshot is not None and time.monotonic() - _snapshot_at <= max_age:
+        return _snapshot
+
+    totals = await read_db["stats"].find_one({"_id": TOTALS_ID}) or {}
+
+    # include events that are still waiting in the buffer, the totals can be off by one flush
+    # and the secondary's replication lag at most
+    for field, amount in counters.pending(TOTALS_ID).items():
+        totals[field] = totals.get(field, 0) + amount
+
+    _snapshot, _snapshot_at = totals, time.monotonic()
+    return totals
+
+
+async def refresh_missing_indexes():
+    # called right after ensure_indexes on every startup, so /stats does not wait for the next reconcile
+    global _snapshot
+    try:
+        await db["stats"].update_one({"_id": TOTALS_ID}, {"$set": {"missing_indexes": await missing_indexes()}}, upsert=True)
+        _snapshot = None
+    except PyMongoError:
+        logger.exception("Could not refresh the missing indexes")
+
+
+async def _run():
+    # reconcile right away on a fresh database, then on a fixed interval. startup writes missing_indexes
+    # before this runs, so only a reconciled_at says the totals were ever counted
+    first = True
+    while True:
+        try:
+            if not first or not await db["stats"].count_documents({"_id": TOTALS_ID, "reconciled_at": {"$exists": True}}, limit=1):
+                await reconcile()
+        except Exception:
+            # e.g. a database error, the next interval tries again
+            logger.exception("Could not reconcile the stats totals")
+        first = False
+        await asyncio.sleep(STATS_RECONCILE_SECONDS)
+
+
+def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+
+def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+def record_post_removed(post):
+    # a deleted post takes its views and votes out of the totals too
+    record(post_count=-1,
+           total_post_views=-post.get("post_views", 0),
+           total_post_upvotes=-post.get("post_upvotes", 0),
+           total_post_downvotes=-post.get("post_downvotes", 0))
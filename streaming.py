@@ -0,0 +1,13 @@
+from fastapi.responses import StreamingResponse
+from serialization import dumps
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def ndjson_response(cursor, serialize):
+    # write one JSON document per line as the cursor is read, so memory stays flat for any result size
+    async def lines():
+        async for batch in cursor.batches():
+            yield "".join(dumps(serialize(document)) + "\n" for document in batch)
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
@@ -0,0 +1,62 @@
+import os
+import time
+import uuid
+import pytest
+
+# the tests run against the in-memory backend, set before the app modules read their settings
+os.environ["DATABASE_BACKEND"] = "memory"
+os.environ.setdefault("SECRET_KEY", "insecure-key-for-the-tests-only-000")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ["DEAL_TIMEZONE"] = "America/Toronto"
+
+from fastapi.testclient import TestClient
+from jobs import jobs
+import main
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def login(client):
+    # registers a user with a fresh name, the memory database is shared by every test
+    def login(prefix: str = "user"):
+        username = f"{prefix}_{uuid.uuid4().hex[:8]}"
+        client.post("/api/v1/users/register",
+                    json={"username": username, "password": "secret1", "user_email": f"{username}@example.com"})
+        token = client.post("/token", data={"username": username, "password": "secret1"}).json()["access_token"]
+        return username, {"Authorization": f"Bearer {token}"}
+    return login
+
+
+@pytest.fixture
+def create_post(client):
+    def create_post(headers: dict, **fields):
+        body = {"post_title": "Nintendo Switch deal", "post_description": "bundle with a game",
+                "post_retailer": "costco", "post_sale_price": 299, **fields}
+        response = client.post("/api/v1/posts/", headers=headers, json=body)
+        assert response.status_code == 200, response.text
+        return response.json()["post_data"]["_id"]
+    return create_post
+
+
+@pytest.fixture
+def wait_for_job():
+    # the background jobs run on the test client's event loop, poll until one finishes
+    def wait_for_job(job_id: str):
+        for _ in range(500):
+            job = jobs.get(job_id)
+            if job.status in ("done", "failed"):
+                assert job.status == "done", job.error
+                return job
+            time.sleep(0.01)
+        raise AssertionError(f"job {job_id} did not finish")
+    return wait_for_job
@@ -0,0 +1,86 @@
+import time
+from bson import ObjectId
+from database import db
+from jobs import Job
+import cascades
+
+
+def test_user_delete_withdraws_votes_and_purchases_from_cached_pages(client, login, create_post, wait_for_job):
+    _, author = login("author")
+    username, voter = login("voter")
+    voted_id = create_post(author)
+    bought_id = create_post(author, post_sale_price=30)
+    assert client.post(f"/api/v1/posts/{voted_id}/upvote", headers=voter).status_code == 200
+    assert client.post(f"/api/v1/users/purchases/{bought_id}/add", headers=voter).status_code == 200
+
+    # cache both pages
+    assert client.get(f"/api/v1/posts/{voted_id}").json()[voted_id]["post"]["post_upvotes"] == 1
+    assert client.get(f"/api/v1/posts/{bought_id}").json()[bought_id]["post"]["bought_count"] == 1
+
+    response = client.delete(f"/api/v1/users/{username}", headers=voter)
+    assert response.status_code == 202, response.text
+    wait_for_job(response.json()["job_id"])
+
+    voted = client.get(f"/api/v1/posts/{voted_id}").json()[voted_id]["post"]
+    assert (voted["post_upvotes"], voted["post_votes"]) == (0, 0)
+    assert client.get(f"/api/v1/posts/{bought_id}").json()[bought_id]["post"]["bought_count"] == 0
+    assert not db[cascades.PENDING_COLLECTION].sync.find_one({"target": username})
+
+
+def test_post_delete_removes_comments_and_their_votes(client, login, create_post, wait_for_job):
+    _, author = login("author")
+    _, commenter = login("commenter")
+    post_id = create_post(author)
+    comment_id = client.post(f"/api/v1/{post_id}/comments", headers=commenter,
+                             json={"comment_body": "nice"}).json()["comment_data"]["_id"]
+    client.post(f"/api/v1/comments/{comment_id}/upvote", headers=author)
+
+    response = client.delete(f"/api/v1/posts/{post_id}", headers=author)
+    assert response.status_code == 202
+    wait_for_job(response.json()["job_id"])
+
+    assert not db["comments"].sync.find_one({"comment_post_id": post_id})
+    assert not db["votes"].sync.find_one({"target_id": ObjectId(comment_id)})
+
+
+def test_user_delete_keeps_the_rollups_of_a_new_account_with_the_same_name(client, login, create_post):
+    _, author = login("author")
+    username, old_account = login("buyer")
+    post_id = create_post(author, post_sale_price=10, post_product_category="Games")
+    client.post(f"/api/v1/users/purchases/{post_id}/add", headers=old_account)
+
+    # the account is deleted, and registered again before its cascade ran
+    deleted_at = ObjectId()
+    db["users"].sync.delete_one({"username": username})
+    client.post("/api/v1/users/register",
+                json={"username": username, "password": "secret1", "user_email": f"{username}@example.com"})
+    token = client.post("/token", data={"username": username, "password": "secret1"}).json()["access_token"]
+    new_account = {"Authorization": f"Bearer {token}"}
+    client.post(f"/api/v1/users/purchases/{post_id}/add", headers=new_account)
+
+    client.portal.call(cascades.delete_user_cascade, Job("delete_user", username), username, deleted_at)
+
+    summary = client.get("/api/v1/users/purchases/summary", headers=new_account).json()
+    assert summary["total_spent"] == 10
+    assert [(category["category"], category["count"]) for category in summary["by_category"]] == [("Games", 1)]
+    assert db["posts"].sync.find_one({"_id": ObjectId(post_id)})["bought_count"] == 1
+
+
+def test_unfinished_cascades_are_resumed(client, login, create_post):
+    _, author = login("author")
+    post_id = create_post(author)
+    client.post(f"/api/v1/{post_id}/comments", headers=author, json={"comment_body": "left behind"})
+
+    # a process deleted the post and stopped before its cascade ran
+    db["posts"].sync.delete_one({"_id": ObjectId(post_id)})
+    db[cascades.PENDING_COLLECTION].sync.insert_one(
+        {"kind": "delete_post", "target": post_id, "args": [post_id], "owner": "stopped-process"})
+
+    assert client.portal.call(cascades.resume_cascades) == 1
+    for _ in range(200):
+        if not db[cascades.PENDING_COLLECTION].sync.find_one({"target": post_id}):
+            break
+        time.sleep(0.01)
+
+    assert not db["comments"].sync.find_one({"comment_post_id": post_id})
+    assert not db[cascades.PENDING_COLLECTION].sync.find_one({"target": post_id})
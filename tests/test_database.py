@@ -0,0 +1,34 @@
+import pytest
+from database import db
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_insert_and_find_round_trip():
+    collection = db["test_database"]
+    await collection.insert_many([{"name": f"deal {i}", "price": i} for i in range(5)])
+
+    found = await collection.find_one({"name": "deal 3"}, projection={"_id": 0})
+    assert found == {"name": "deal 3", "price": 3}
+
+    cheap = await collection.find({"price": {"$lt": 3}}).sort("price", -1).limit(2).to_list()
+    assert [document["price"] for document in cheap] == [2, 1]
+
+
+async def test_cursor_batches():
+    collection = db["test_database_batches"]
+    await collection.insert_many([{"n": i} for i in range(7)])
+
+    batches = [batch async for batch in collection.find().sort("n", 1).batches(size=3)]
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+async def test_shared_projection_is_not_changed():
+    # mongomock adds _id to the projection it is given, the wrapper hands it a copy
+    collection = db["test_database_projection"]
+    await collection.insert_one({"name": "deal", "hidden": True})
+    projection = {"hidden": 0}
+
+    await collection.find({}, projection=projection).to_list()
+    await collection.find_one({}, projection=projection)
+    assert projection == {"hidden": 0}
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime
+import expiry
+from expiry import parse_deal_expiry
+
+
+def test_expiry_is_read_in_the_site_time_zone():
+    # America/Toronto is UTC-5 in winter and UTC-4 in summer
+    assert parse_deal_expiry("2024-01-31 23:59") == datetime(2024, 2, 1, 4, 59)
+    assert parse_deal_expiry("2024-07-01") == datetime(2024, 7, 2, 4, 0)
+
+
+def test_unknown_format_never_expires():
+    assert parse_deal_expiry("while supplies last") is None
+
+
+def test_archiver_keeps_running_after_any_error(monkeypatch):
+    runs = []
+
+    async def archive_expired():
+        runs.append(1)
+        if len(runs) == 1:
+            raise RuntimeError("cache unavailable")
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(expiry, "archive_expired", archive_expired)
+    monkeypatch.setattr(expiry, "ARCHIVE_INTERVAL_SECONDS", 0)
+
+    async def run():
+        try:
+            await expiry._run()
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert len(runs) == 2
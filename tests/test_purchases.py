@@ -0,0 +1,46 @@
+from bson import ObjectId
+from database import db
+from jobs import Job
+from purchases import reconcile_purchases
+
+
+def test_purchase_updates_every_counter(client, login, create_post):
+    _, author = login("author")
+    username, buyer = login("buyer")
+    post_id = create_post(author, post_sale_price=50, post_product_category="Electronics")
+    client.get(f"/api/v1/posts/{post_id}")  # cache the post page
+    client.get("/api/v1/users/me", headers=buyer)  # and the buyer
+
+    assert client.post(f"/api/v1/users/purchases/{post_id}/add", headers=buyer).status_code == 200
+
+    assert client.get("/api/v1/users/me", headers=buyer).json()["user_spent_total"] == 50
+    assert client.get(f"/api/v1/posts/{post_id}").json()[post_id]["post"]["bought_count"] == 1
+    summary = client.get("/api/v1/users/purchases/summary", headers=buyer).json()
+    assert summary["total_spent"] == 50
+    assert [(category["category"], category["count"]) for category in summary["by_category"]] == [("Electronics", 1)]
+
+    assert client.post(f"/api/v1/users/purchases/{post_id}/remove", headers=buyer).status_code == 200
+
+    assert client.get("/api/v1/users/me", headers=buyer).json()["user_spent_total"] == 0
+    assert client.get(f"/api/v1/posts/{post_id}").json()[post_id]["post"]["bought_count"] == 0
+    assert client.get("/api/v1/users/purchases/summary", headers=buyer).json()["total_spent"] == 0
+
+
+def test_reconcile_rebuilds_counters_from_the_ledger(client, login, create_post):
+    _, author = login("author")
+    username, buyer = login("buyer")
+    post_id = create_post(author, post_sale_price=20)
+    client.post(f"/api/v1/users/purchases/{post_id}/add", headers=buyer)
+    client.post(f"/api/v1/users/purchases/{post_id}/add", headers=buyer)
+
+    # counters that drifted from the ledger, e.g. after a failed update
+    db["posts"].sync.update_one({"_id": ObjectId(post_id)}, {"$set": {"bought_count": 7}})
+    db["users"].sync.update_one({"username": username}, {"$set": {"user_spent_total": 0}})
+    db["purchase_monthly"].sync.insert_one({"username": username, "month": "1999-01", "total": 5, "count": 1})
+
+    client.portal.call(reconcile_purchases, Job("reconcile_purchases", username), username, [post_id])
+
+    assert db["posts"].sync.find_one({"_id": ObjectId(post_id)})["bought_count"] == 2
+    assert client.get("/api/v1/users/me", headers=buyer).json()["user_spent_total"] == 40
+    summary = client.get("/api/v1/users/purchases/summary", headers=buyer).json()
+    assert [(month["total"], month["count"]) for month in summary["by_month"]] == [(40, 2)]
@@ -0,0 +1,45 @@
+def test_post_and_comment_round_trip(client, login, create_post):
+    _, headers = login()
+    post_id = create_post(headers)
+
+    post = client.get(f"/api/v1/posts/{post_id}").json()[post_id]["post"]
+    assert post["post_title"] == "Nintendo Switch deal"
+    assert "post_search_terms" not in post
+
+    response = client.post(f"/api/v1/{post_id}/comments", headers=headers, json={"comment_body": "still in stock"})
+    assert response.status_code == 200
+
+    # creating the comment drops the cached post page, so the new comment shows up on the next read
+    comments = client.get(f"/api/v1/posts/{post_id}").json()[post_id]["comments"]
+    assert [comment["comment_body"] for comment in comments] == ["still in stock"]
+
+
+def test_unknown_post_is_404(client):
+    assert client.get("/api/v1/posts/000000000000000000000000").status_code == 404
+
+
+def test_cached_post_page_follows_updates_and_comment_deletes(client, login, create_post):
+    _, headers = login()
+    post_id = create_post(headers)
+    comment_id = client.post(f"/api/v1/{post_id}/comments", headers=headers,
+                             json={"comment_body": "gone soon"}).json()["comment_data"]["_id"]
+    client.get(f"/api/v1/posts/{post_id}")  # cache the page
+
+    assert client.put(f"/api/v1/posts/{post_id}", headers=headers, json={"post_title": "Price drop"}).status_code == 200
+    page = client.get(f"/api/v1/posts/{post_id}").json()[post_id]
+    assert page["post"]["post_title"] == "Price drop"
+
+    assert client.delete(f"/api/v1/comments/{comment_id}", headers=headers).status_code == 200
+    page = client.get(f"/api/v1/posts/{post_id}").json()[post_id]
+    assert "comments" not in page
+    assert page["post"]["post_comments_count"] == 0
+
+
+def test_etag_revalidation(client, login, create_post):
+    _, headers = login()
+    post_id = create_post(headers)
+    etag = client.get(f"/api/v1/posts/{post_id}").headers["etag"]
+    assert client.get(f"/api/v1/posts/{post_id}", headers={"If-None-Match": etag}).status_code == 304
+
+    client.put(f"/api/v1/posts/{post_id}", headers=headers, json={"post_sale_price": 199})
+    assert client.get(f"/api/v1/posts/{post_id}", headers={"If-None-Match": etag}).status_code == 200
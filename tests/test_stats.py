@@ -0,0 +1,74 @@
+import asyncio
+import stats
+from database import db
+
+
+def test_stats_etag_survives_unrelated_requests(client, login):
+    # the hot-path counters live on /stats/runtime, so reads elsewhere do not change the /stats tag
+    login()
+    # nothing left in the write-behind buffer, so no flush lands between the two reads
+    client.portal.call(stats.counters.flush)
+    first = client.get("/stats")
+    client.get("/api/v1/users/")
+    client.get("/api/v1/posts/000000000000000000000000")
+
+    second = client.get("/stats", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 304
+
+    runtime = client.get("/stats/runtime").json()["metrics"]
+    assert {"password_hashing", "database_pool", "post_page_cache"} <= set(runtime)
+
+
+def test_stats_reconciled_at_is_utc(client):
+    reconciled_at = client.get("/stats").json()["metrics"]["reconciled_at"]
+    assert reconciled_at is None or reconciled_at.endswith("+00:00")
+
+
+class FreshStats:
+    """A stats collection that was never reconciled."""
+
+    async def count_documents(self, *args, **kwargs):
+        return 0
+
+
+def test_reconciler_keeps_running_after_any_error(monkeypatch):
+    runs = []
+
+    async def reconcile():
+        runs.append(1)
+        if len(runs) == 1:
+            raise RuntimeError("unexpected")
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(stats, "reconcile", reconcile)
+    monkeypatch.setattr(stats, "STATS_RECONCILE_SECONDS", 0)
+    # the first pass only reconciles a database that was never counted
+    monkeypatch.setattr(stats, "db", {"stats": FreshStats()})
+
+    async def run():
+        try:
+            await stats._run()
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert len(runs) == 2
+
+
+def test_reconcile_matches_the_collections(client, login, create_post):
+    _, headers = login()
+    create_post(headers)
+    # drift the stored totals, the reconciler recounts them
+    db["stats"].sync.update_one({"_id": stats.TOTALS_ID}, {"$set": {"post_count": -5}})
+
+    client.portal.call(stats.reconcile)
+
+    counts = client.get("/stats").json()["metrics"]["document_counts"]
+    assert counts == {"user_count": db["users"].sync.count_documents({}),
+                      "post_count": db["posts"].sync.count_documents({}),
+                      "comment_count": db["comments"].sync.count_documents({})}
+
+
+def test_startup_lists_the_missing_indexes(client):
+    # written by the startup hook right after ensure_indexes, before any reconcile
+    assert "missing_indexes" in db["stats"].sync.find_one({"_id": stats.TOTALS_ID})
@@ -0,0 +1,11 @@
+def test_me_shows_current_counters(client, login, create_post):
+    username, headers = login()
+    assert client.get("/api/v1/users/me", headers=headers).json()["user_post_count"] == 0
+
+    create_post(headers)
+    create_post(headers)
+
+    me = client.get("/api/v1/users/me", headers=headers).json()
+    assert me["username"] == username
+    assert me["user_post_count"] == 2
+    assert "hashed_password" not in me
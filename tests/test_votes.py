@@ -0,0 +1,51 @@
+from bson import ObjectId
+from database import db
+
+
+def post_counts(client, post_id: str):
+    post = client.get(f"/api/v1/posts/{post_id}").json()[post_id]["post"]
+    return post["post_votes"], post["post_upvotes"], post["post_downvotes"]
+
+
+def test_vote_change_and_repeat(client, login, create_post):
+    _, author = login("author")
+    _, voter = login("voter")
+    post_id = create_post(author)
+    assert post_counts(client, post_id) == (0, 0, 0)  # cache the page
+
+    assert client.post(f"/api/v1/posts/{post_id}/upvote", headers=voter).status_code == 200
+    assert post_counts(client, post_id) == (1, 1, 0)
+    assert client.post(f"/api/v1/posts/{post_id}/upvote", headers=voter).status_code == 400
+
+    # a changed vote cancels the old one
+    assert client.post(f"/api/v1/posts/{post_id}/downvote", headers=voter).status_code == 200
+    assert post_counts(client, post_id) == (-1, 0, 1)
+
+    # a first vote moves reputation by one, a changed vote by two, /me counts what is still buffered
+    assert client.get("/api/v1/users/me", headers=author).json()["user_reputation"] == -1
+
+
+def test_cannot_vote_on_own_or_missing_post(client, login, create_post):
+    _, author = login("author")
+    post_id = create_post(author)
+    assert client.post(f"/api/v1/posts/{post_id}/upvote", headers=author).status_code == 400
+    assert client.post("/api/v1/posts/000000000000000000000000/upvote", headers=author).status_code == 404
+    assert not db["votes"].sync.find_one({"target_id": ObjectId(post_id)})
+
+
+def test_comment_votes_show_on_the_cached_post_page(client, login, create_post, wait_for_job):
+    _, author = login("author")
+    username, voter = login("voter")
+    post_id = create_post(author)
+    comment_id = client.post(f"/api/v1/{post_id}/comments", headers=author,
+                             json={"comment_body": "in stock"}).json()["comment_data"]["_id"]
+    client.get(f"/api/v1/posts/{post_id}")  # cache the page
+
+    assert client.post(f"/api/v1/comments/{comment_id}/upvote", headers=voter).status_code == 200
+    comment = client.get(f"/api/v1/posts/{post_id}").json()[post_id]["comments"][0]
+    assert (comment["comment_votes"], comment["comment_upvotes"]) == (1, 1)
+
+    # deleting the voter withdraws the vote, from the cached page too
+    wait_for_job(client.delete(f"/api/v1/users/{username}", headers=voter).json()["job_id"])
+    comment = client.get(f"/api/v1/posts/{post_id}").json()[post_id]["comments"][0]
+    assert (comment["comment_votes"], comment["comment_upvotes"]) == (0, 0)
@@ -0,0 +1,237 @@
+import logging
+import os
+import random
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+from serialization import utcnow
+from metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+# share of requests whose MongoDB commands are traced, 0 turns request tracing off and 1 traces every request
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))
+
+# commands at least this slow go to the slow-query log, whether or not their request was sampled
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 100))
+
+# how many traced requests and slow commands are kept in memory
+TRACE_HISTORY = int(os.environ.get("TRACE_HISTORY", 200))
+SLOW_QUERY_HISTORY = int(os.environ.get("SLOW_QUERY_HISTORY", 500))
+
+# the command fields that say which documents a command reads or writes, by command name
+FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "aggregate": "pipeline",
+}
+
+# the commands explain understands
+EXPLAINABLE = {"find", "count", "distinct", "findAndModify", "aggregate", "update", "delete"}
+
+# session and routing fields the driver adds to each command, explain rejects them
+DRIVER_FIELDS = {"lsid", "txnNumber", "$clusterTime", "$db", "$readPreference", "readConcern", "writeConcern"}
+
+_request_trace = ContextVar("request_trace", default=None)
+
+
+class CommandTrace:
+    """One MongoDB command: what it touched, how long it took and how many documents came back."""
+
+    __slots__ = ("command_name", "collection", "filter", "duration_ms", "docs_returned", "error",
+                 "slow", "plan", "started_at", "_command")
+
+    def __init__(self, command: dict, command_name: str):
+        self.command_name = command_name
+        # getMore names the collection in its own field, every other command under its name
+        self.collection = command.get("collection") if command_name == "getMore" else command.get(command_name)
+        self.filter = _command_filter(command, command_name)
+        self.duration_ms = None
+        self.docs_returned = None
+        self.error = None
+        self.slow = False
+        # filled in by explain(), e.g. "IXSCAN" or "COLLSCAN"
+        self.plan = None
+        self.started_at = utcnow()
+        # kept for explain only, so the documents of inserts are not held on to
+        self._command = command if command_name in EXPLAINABLE else None
+
+    def to_dict(self):
+        return {
+            "command": self.command_name,
+            "collection": self.collection,
+            "filter": self.filter,
+            "duration_ms": self.duration_ms,
+            "docs_returned": self.docs_returned,
+            "error": self.error,
+            "slow": self.slow,
+            "plan": self.plan,
+            "unindexed": self.plan == "COLLSCAN" if self.plan not in (None, "unknown") else None,
+            "started_at": self.started_at,
+        }
+
+
+class RequestTrace:
+    """The commands one sampled request issued."""
+
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status_code = None
+        self.duration_ms = None
+        self.started_at = utcnow()
+        self.commands = []
+
+    def to_dict(self, commands: bool = True):
+        summary = {
+            "trace_id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status_code": self.status_code,
+            "duration_ms": self.duration_ms,
+            "started_at": self.started_at,
+            "command_count": len(self.commands),
+            "database_ms": round(sum(command.duration_ms or 0 for command in self.commands), 3),
+            "slow_commands": sum(command.slow for command in self.commands),
+        }
+        if commands:
+            summary["commands"] = [command.to_dict() for command in self.commands]
+        return summary
+
+
+def _command_filter(command: dict, command_name: str):
+    if command_name in FILTER_FIELDS:
+        return command.get(FILTER_FIELDS[command_name])
+    # writes carry a list of statements, each with its own query
+    if command_name == "update":
+        return [statement.get("q") for statement in command.get("updates", [])]
+    if command_name == "delete":
+        return [statement.get("q") for statement in command.get("deletes", [])]
+    return None
+
+
+def _docs_returned(reply: dict):
+    # find, aggregate and getMore return a cursor batch, count and the writes return n
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if "values" in reply:
+        return len(reply["values"])
+    if "value" in reply:
+        return 0 if reply["value"] is None else 1
+    return reply.get("n")
+
+
+class Tracer(monitoring.CommandListener):
+    """Keeps the commands of sampled requests and every slow command."""
+
+    def __init__(self):
+        self.traces = deque(maxlen=TRACE_HISTORY)
+        self.slow_queries = deque(maxlen=SLOW_QUERY_HISTORY)
+        # commands in flight by request id, pymongo reports start and finish as separate events
+        self._started = {}
+
+    def started(self, event):
+        self._started[event.request_id] = (CommandTrace(event.command, event.command_name),
+                                           _request_trace.get())
+
+    def succeeded(self, event):
+        self._finish(event, docs_returned=_docs_returned(event.reply))
+
+    def failed(self, event):
+        self._finish(event, error=str(event.failure.get("errmsg", event.failure)))
+
+    def _finish(self, event, docs_returned=None, error=None):
+        started = self._started.pop(event.request_id, None)
+        if started is None:
+            return
+        command, trace = started
+        command.duration_ms = round(event.duration_micros / 1000, 3)
+        command.docs_returned = docs_returned
+        command.error = error
+        command.slow = command.duration_ms >= TRACE_SLOW_MS
+        if trace is not None:
+            trace.commands.append(command)
+        if command.slow:
+            self.slow_queries.append(command)
+
+    def find(self, trace_id: str):
+        for trace in self.traces:
+            if trace.id == trace_id:
+                return trace
+        return None
+
+
+tracer = Tracer()
+
+
+async def explain(db, commands):
+    # ask the server how it ran each command, a COLLSCAN means no index served it.
+    # explain is another round trip per command, so it only runs when an admin asks and each command once
+    for command in commands:
+        if command.plan is not None or command._command is None:
+            continue
+        body = {key: value for key, value in command._command.items() if key not in DRIVER_FIELDS}
+        try:
+            result = await db.command({"explain": body, "verbosity": "queryPlanner"})
+        except PyMongoError as error:
+            logger.warning("Could not explain %s on %s: %s", command.command_name, command.collection, error)
+            command.plan = "unknown"
+            continue
+        command.plan = "COLLSCAN" if _has_stage(result, "COLLSCAN") else _winning_stage(result)
+
+
+def _has_stage(node, stage: str):
+    # walk the whole explain output, the stage can sit under queryPlanner, shards or aggregation stages
+    if isinstance(node, dict):
+        return node.get("stage") == stage or any(_has_stage(value, stage) for value in node.values())
+    if isinstance(node, list):
+        return any(_has_stage(value, stage) for value in node)
+    return False
+
+
+def _winning_stage(result: dict):
+    # the innermost stage of the winning plan, e.g. IXSCAN or IDHACK
+    plan = result.get("queryPlanner", {}).get("winningPlan", {})
+    while "inputStage" in plan:
+        plan = plan["inputStage"]
+    return plan.get("stage", "unknown")
+
+
+class TracingMiddleware:
+    """Pure ASGI middleware tracing the MongoDB commands of a sample of requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope["method"], scope["path"])
+
+        async def send_with_trace_id(message):
+            # the response names its trace, so a slow call can be looked up on /admin/traces/{trace_id}
+            if message["type"] == "http.response.start":
+                trace.status_code = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", trace.id.encode())]
+            await send(message)
+
+        token = _request_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            trace.duration_ms = round((time.perf_counter() - started) * 1000, 3)
+            trace.route = route_template(scope)
+            _request_trace.reset(token)
+            tracer.traces.append(trace)
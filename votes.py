@@ -0,0 +1,139 @@
+from collections import defaultdict
+from bson import ObjectId
+from fastapi import HTTPException, status
+from pymongo import UpdateOne
+from pymongo.collection import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from database import db
+from cache import post_pages
+from write_behind import user_reputation
+from ranking import increment_and_rescore
+import stats
+
+UPVOTE = 1
+DOWNVOTE = -1
+
+# where each votable type keeps its counters and author, the voters themselves live in the votes collection
+TARGETS = {
+    "post": {"collection": "posts", "votes_field": "post_votes", "upvotes_field": "post_upvotes",
+             "downvotes_field": "post_downvotes", "author_field": "post_author", "post_field": "_id"},
+    "comment": {"collection": "comments", "votes_field": "comment_votes", "upvotes_field": "comment_upvotes",
+                "downvotes_field": "comment_downvotes", "author_field": "comment_author", "post_field": "comment_post_id"},
+}
+
+
+def vote_key(target_type: str, target_id, username: str):
+    # one vote document per (target, user), backed by a unique index
+    return {"target_type": target_type, "target_id": ObjectId(target_id), "username": username}
+
+
+async def _record_vote(key: dict, direction: int):
+    # upsert the user's vote and hand back the one it replaced, None for a first vote
+    try:
+        return await db["votes"].find_one_and_update(key, {"$set": {"direction": direction}},
+                                                     upsert=True, return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError:
+        # a concurrent first vote by the same user inserted the document, it exists now
+        return await db["votes"].find_one_and_update(key, {"$set": {"direction": direction}},
+                                                     return_document=ReturnDocument.BEFORE)
+
+
+async def _restore_vote(key: dict, previous):
+    # undo _record_vote when the vote turns out to be invalid
+    if previous is None:
+        await db["votes"].delete_one(key)
+    else:
+        await db["votes"].update_one(key, {"$set": {"direction": previous["direction"]}})
+
+
+async def cast_vote(target_type: str, target_id: str, username: str, direction: int):
+    # returns the target's author and post id (post_field), so callers can invalidate cached pages
+    target = TARGETS[target_type]
+    voted_field = target["upvotes_field"] if direction == UPVOTE else target["downvotes_field"]
+    opposite_field = target["downvotes_field"] if direction == UPVOTE else target["upvotes_field"]
+    verb = "upvoted" if direction == UPVOTE else "downvoted"
+
+    key = vote_key(target_type, target_id, username)
+    previous = await _record_vote(key, direction)
+
+    # voting the same way twice changes nothing
+    if previous is not None and previous["direction"] == direction:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"You already {verb} this {target_type}!")
+
+    # a first vote moves the score by one, a changed vote also cancels the old one
+    if previous is None:
+        delta = direction
+        counters = {target["votes_field"]: delta, voted_field: 1}
+    else:
+        delta = 2 * direction
+        counters = {target["votes_field"]: delta, voted_field: 1, opposite_field: -1}
+
+    # a post is rescored for the hot feed in the same write as its counters
+    update = increment_and_rescore(target_id, counters) if target_type == "post" else {"$inc": counters}
+
+    # the author check rides along with the counter update, so a valid vote costs two round trips
+    document = await db[target["collection"]].find_one_and_update(
+        {"_id": ObjectId(target_id), target["author_field"]: {"$ne": username}},
+        update,
+        projection={target["author_field"]: 1, target["post_field"]: 1},
+    )
+    if document:
+        user_reputation.add(document[target["author_field"]], "user_reputation", delta)
+        if target_type == "post":
+            stats.record(total_post_upvotes=counters.get("post_upvotes", 0),
+                         total_post_downvotes=counters.get("post_downvotes", 0))
+        return document
+
+    # the target is missing or the user wrote it, take the vote back and explain why
+    await _restore_vote(key, previous)
+    if await db[target["collection"]].count_documents({"_id": ObjectId(target_id)}, limit=1):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Cannot vote on your own {target_type}!")
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                        detail=f"{target_type.capitalize()} not found.")
+
+
+async def get_voters(target_type: str, target_id):
+    # the voter lists are only read when a client asks for them
+    voters = {"users_who_upvoted": [], "users_who_downvoted": []}
+    query = {"target_type": target_type, "target_id": ObjectId(target_id)}
+    async for vote in db["votes"].find(query, projection={"username": 1, "direction": 1}):
+        field = "users_who_upvoted" if vote["direction"] == UPVOTE else "users_who_downvoted"
+        voters[field].append(vote["username"])
+    return voters
+
+
+async def withdraw_votes(votes: list):
+    # take a batch of vote documents back out of their targets' counters and their authors' reputation,
+    # e.g. when the voter is deleted, the caller deletes the vote documents themselves
+    for target_type, target in TARGETS.items():
+        deltas = defaultdict(lambda: defaultdict(int))
+        for vote in votes:
+            if vote["target_type"] == target_type:
+                voted_field = target["upvotes_field"] if vote["direction"] == UPVOTE else target["downvotes_field"]
+                deltas[vote["target_id"]][target["votes_field"]] -= vote["direction"]
+                deltas[vote["target_id"]][voted_field] -= 1
+        if not deltas:
+            continue
+
+        # targets deleted in the meantime have no counters left to correct
+        collection = db[target["collection"]]
+        documents = await collection.find({"_id": {"$in": list(deltas)}},
+                                          projection={target["author_field"]: 1, target["post_field"]: 1}).to_list()
+        authors = {document["_id"]: document[target["author_field"]] for document in documents}
+
+        requests = []
+        for target_id, author in authors.items():
+            counters = dict(deltas[target_id])
+            update = increment_and_rescore(target_id, counters) if target_type == "post" else {"$inc": counters}
+            requests.append(UpdateOne({"_id": target_id}, update))
+            user_reputation.add(author, "user_reputation", counters[target["votes_field"]])
+            if target_type == "post":
+                stats.record(total_post_upvotes=counters.get("post_upvotes", 0),
+                             total_post_downvotes=counters.get("post_downvotes", 0))
+        if requests:
+            await collection.bulk_write(requests, ordered=False)
+        # the cached post pages show these counters, a comment's on the page of its post
+        for post_id in {document[target["post_field"]] for document in documents}:
+            await post_pages.invalidate(post_id)
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from pymongo import UpdateOne
+from pymongo.errors import ConnectionFailure, ExceededMaxWaiters, PyMongoError, ServerSelectionTimeoutError
+from database import db
+from ranking import increment_and_rescore
+
+logger = logging.getLogger(__name__)
+
+# a buffer is flushed every FLUSH_SECONDS, or sooner once FLUSH_EVENTS increments are waiting
+FLUSH_SECONDS = float(os.environ.get("WRITE_BEHIND_FLUSH_SECONDS", 1.0))
+FLUSH_EVENTS = int(os.environ.get("WRITE_BEHIND_FLUSH_EVENTS", 1000))
+
+buffers = []
+
+
+def _not_sent(error):
+    # only errors raised before the batch left the process are safe to retry: no server could be selected,
+    # or no pooled connection freed up in time. pymongo 3 raises a bare ConnectionFailure for the latter,
+    # its subclasses such as AutoReconnect and NetworkTimeout can come after the server applied the batch
+    return isinstance(error, (ServerSelectionTimeoutError, ExceededMaxWaiters)) or type(error) is ConnectionFailure
+
+
+class IncrementBuffer:
+    """Collects $inc updates in memory and writes them out in batches with one bulk_write."""
+
+    def __init__(self, collection_name: str, key_field: str = "_id", upsert: bool = False, pipeline=None):
+        self.collection_name = collection_name
+        self.key_field = key_field
+        self.upsert = upsert
+        # optional pipeline(key, fields) that replaces the plain $inc, e.g. to keep a derived field in step
+        self.pipeline = pipeline
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._events = 0
+        self._lock = asyncio.Lock()
+        self._wakeup = None
+        self._task = None
+        buffers.append(self)
+
+    def add(self, key, field: str, amount: int = 1):
+        self._pending[key][field] += amount
+        self._events += 1
+        if self._events >= FLUSH_EVENTS and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self, key):
+        # increments for key that have not been written yet
+        return dict(self._pending.get(key, {}))
+
+    def _requeue(self, pending):
+        for key, fields in pending.items():
+            for field, amount in fields.items():
+                self._pending[key][field] += amount
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+
+            # swap the buffer out so new increments collect while this batch is written
+            pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+            self._events = 0
+
+            try:
+                requests = [UpdateOne({self.key_field: key},
+                                      self.pipeline(key, dict(fields)) if self.pipeline else {"$inc": dict(fields)},
+                                      upsert=self.upsert)
+                            for key, fields in pending.items()]
+                await db[self.collection_name].bulk_write(requests, ordered=False)
+            except PyMongoError as error:
+                if _not_sent(error):
+                    # nothing reached the server, keep the increments for the next flush
+                    logger.warning("Could not flush %s increments, retrying later: %s", self.collection_name, error)
+                    self._requeue(pending)
+                else:
+                    # part of the batch may have been applied, retrying could count it twice
+                    logger.exception("Dropped a batch of %s increments", self.collection_name)
+            except Exception:
+                # raised while building or encoding the batch, e.g. bson's InvalidDocument, before anything was sent
+                logger.exception("Could not flush %s increments, retrying later", self.collection_name)
+                self._requeue(pending)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # flush handles the errors it knows, anything else must not stop this buffer for good
+                logger.exception("Flushing %s increments failed", self.collection_name)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+def start():
+    for buffer in buffers:
+        buffer.start()
+
+
+async def stop():
+    # flush whatever is still buffered so no increments are lost on shutdown
+    for buffer in buffers:
+        await buffer.stop()
+
+
+# post views, keyed by the post ObjectId, each flush also rescores the posts for the hot feed
+post_views = IncrementBuffer("posts", pipeline=increment_and_rescore)
+
+# author reputation from votes, keyed by username
+user_reputation = IncrementBuffer("users", "username")